@@ -1,13 +1,24 @@
+import array
+import bisect
+import contextlib
+import copy
 import functools
+import gc
+import itertools
+import mmap
+import os
+import pickle  # nosec
 import struct
+import weakref
 from typing import cast
 
 from typing_extensions import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from collections.abc import Callable
-    from typing import Optional  # pylint: disable=ungrouped-imports # isort: split
-    from typing_extensions import Final
+    import socket
+    from collections.abc import Callable, Hashable, Iterable, Iterator
+    from typing import Any, BinaryIO, Optional, Union  # pylint: disable=ungrouped-imports # isort: split
+    from typing_extensions import Buffer, Final
 
 # Integer packing utilities.
 
@@ -36,14 +47,8 @@ def pack(x: int, *, endian: str, word_size: 'Optional[int]' = None, signed: bool
     endian = _endian_dict[endian]
     word_size_code = _word_size_dict[word_size]
     if word_size_code is None:  # automatically determine byte length
-        if signed:  # adapted from pickle.encode_long()
-            if x == 0:
-                return b''
-            nbytes = (x.bit_length() >> 3) + 1
-            result = x.to_bytes(nbytes, byteorder='little', signed=True)
-            if x < 0 and nbytes > 1:
-                if result[-1] == 0xff and (result[-2] & 0x80) != 0:
-                    result = result[:-1]
+        if signed:
+            result = _encode_long(x)
             return result if endian == 'little' else result[::-1]
         return x.to_bytes((x.bit_length() + 7) >> 3, byteorder=endian, signed=False)
     if not signed:
@@ -59,6 +64,29 @@ p16 = functools.partial(pack, word_size=16, endian='<')
 p32 = functools.partial(pack, word_size=32, endian='<')
 p64 = functools.partial(pack, word_size=64, endian='<')
 
+
+def _encode_long(x: int) -> bytes:
+    # Pack a signed integer into as few bytes as possible in little endian, adapted from pickle.encode_long().
+    if x == 0:
+        return b''
+    nbytes = (x.bit_length() >> 3) + 1
+    result = x.to_bytes(nbytes, byteorder='little', signed=True)
+    if x < 0 and nbytes > 1:
+        if result[-1] == 0xff and (result[-2] & 0x80) != 0:
+            result = result[:-1]
+    return result
+
+
+# Precompiled structs to pack an opcode together with its fixed-size argument in a single call.
+# Unlike `pack`, they do not validate their arguments, so callers should check the range of integers beforehand.
+_pack_opcode_u8 = struct.Struct('<cB').pack  # type: Final[Callable[[bytes, int], bytes]]
+_pack_opcode_u16 = struct.Struct('<cH').pack  # type: Final[Callable[[bytes, int], bytes]]
+_pack_opcode_i32 = struct.Struct('<ci').pack  # type: Final[Callable[[bytes, int], bytes]]
+_pack_opcode_u32 = struct.Struct('<cI').pack  # type: Final[Callable[[bytes, int], bytes]]
+_pack_opcode_u64 = struct.Struct('<cQ').pack  # type: Final[Callable[[bytes, int], bytes]]
+_pack_opcode_f64 = struct.Struct('>cd').pack  # type: Final[Callable[[bytes, float], bytes]]  # big endian for BINFLOAT
+_pack_u64_into = struct.Struct('<Q').pack_into  # type: Final[Callable[[bytearray, int, int], None]]
+
 # The highest protocol number that we can generate.
 HIGHEST_PROTOCOL = 5  # type: Final[int]
 
@@ -76,6 +104,9 @@ class Opcode(bytes):
         obj.proto = proto
         return obj
 
+    def __reduce__(self) -> 'tuple[type[Opcode], tuple[str, bytes, int]]':
+        return Opcode, (self.name, self.code, self.proto)
+
 
 # Pickle opcodes from pickle.py
 
@@ -168,15 +199,79 @@ BYTEARRAY8       = Opcode('BYTEARRAY8',       b'\x96', 5)  # push bytearray
 NEXT_BUFFER      = Opcode('NEXT_BUFFER',      b'\x97', 5)  # push next out-of-band buffer
 READONLY_BUFFER  = Opcode('READONLY_BUFFER',  b'\x98', 5)  # make top of stack readonly
 
+_FRAME_HEADER_PLACEHOLDER = FRAME + bytes(8)  # type: Final[bytes]  # the frame size is filled in later
+
+_PickleBuffer = getattr(pickle, 'PickleBuffer', None)  # type: Final[Optional[type]]  # new in Python 3.8
+
+_writev = getattr(os, 'writev', None)  # type: Final[Optional[Callable[[int, list[memoryview]], int]]]  # POSIX only
+try:
+    _IOV_MAX = max(os.sysconf('SC_IOV_MAX'), 16)  # type: int  # maximum number of buffers for vectored I/O
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    _IOV_MAX = 16  # the minimum required by POSIX
+
+
+if TYPE_CHECKING:
+    # An iterator over the items of a container being pushed by `util_push`, and the function to call to build the
+    # container afterwards; or None if the value has been pushed entirely.
+    _UtilPushFrame = Optional[tuple[Iterable[object], Callable[[], None]]]
+    # The encoding of an instruction recorded in `PickleIR`: the opcode with its argument, or the opcode (with the
+    # size of the argument) followed by the pieces of the argument, which is written separately.
+    _Encoding = Union[bytes, tuple[Union[bytes, memoryview], ...]]
+
 
 class PickleAssembler:
     """Pickle assembler."""
-    def __init__(self, proto: int = 0, verify: bool = True) -> None:
+
+    # The subclasses of this class specialized for each protocol (or None) and for incremental validation (see
+    # `__new__`), created when first needed.
+    _protocol_classes = {}  # type: dict[tuple[Optional[int], bool], type[PickleAssembler]]
+
+    def __new__(cls, proto: int = 0, verify: bool = True, **kwargs: object) -> 'PickleAssembler':
+        # Protocol verification is resolved once per assembler: the assembler is created as an instance of a subclass
+        # in which opcode methods requiring a higher protocol are replaced with stubs that raise, so the opcode
+        # methods themselves need no checks. With ``validate='incremental'``, opcode methods of the subclass are
+        # also wrapped to update the stack model. Invalid arguments are left to `__init__`.
+        validated = kwargs.get('validate') == 'incremental'
+        if verify is True and isinstance(proto, int) and 0 <= proto <= HIGHEST_PROTOCOL:
+            return super().__new__(_protocol_class(cls, proto, validated))
+        return super().__new__(_protocol_class(cls, None, validated))
+
+    def __init__(self, proto: int = 0, verify: bool = True, *,
+                 sink: 'Optional[BinaryIO]' = None, buffer_size: int = 64 * 1024,
+                 batch_size: 'Optional[int]' = None, memoize: 'Optional[str]' = None,
+                 frame_size: 'Optional[int]' = None, ir: bool = False, validate: 'Optional[str]' = None) -> None:
         """Create a new pickle assembler.
 
         Args:
             proto: the protocol version to generate, a protocol header will be generated if ``proto`` >= 2
             verify: whether to check opcodes against the protocol number
+            sink: if given, a writable binary stream to which opcodes are written as they are generated,
+                instead of keeping the whole payload in memory
+            buffer_size: the size of the internal write buffer used when writing to ``sink`` (when framing, a frame
+                is buffered at a time instead); without a sink, opcode arguments (e.g. of ``BINBYTES``) of at least
+                ``buffer_size`` bytes are referenced by the payload rather than copied into it, so they should not
+                be modified until the payload is assembled
+            batch_size: if given, `util_push` builds non-empty lists and dicts by adding items to an empty container
+                in batches of at most ``batch_size`` items (with ``APPENDS`` / ``SETITEMS``), so that the unpickler
+                does not have to keep all items on its stack at once
+            memoize: if given, `util_push` stores bytes, str, tuple, list and dict objects in the memo when pushing
+                them for the first time, and pushes them from the memo when they occur again; objects are considered
+                the same if they are identical (``'identity'``), or in addition, bytes and str objects are considered
+                the same if they are equal (``'equality'``); memo entries are allocated with `memo_allocator`
+            frame_size: if given, the payload is split into frames (with ``FRAME``) of about ``frame_size`` bytes,
+                so that unpicklers reading from a file can read a frame at a time instead of each opcode separately;
+                as with pickle, arguments of at least ``frame_size`` bytes are kept out of frames; requires
+                protocol 4 or above
+            ir: if true, opcodes are recorded as instructions in `ir` and only encoded into the payload when it is
+                assembled, so that they can be analyzed and transformed beforehand; memo indices of `memo_allocator`
+                are picked when the instructions are read, encoded or optimized
+            validate: if ``'assemble'``, the stack effects of the payload are checked with `simulate` whenever it is
+                output (by `assemble`, `view`, `assemble_into`, `write_to_fd` or `send_to_socket`), raising
+                `PickleValidationError` if it is malformed, and `max_stack_depth` is set; cannot be used with a sink;
+                if ``'incremental'``, the stack effects of each opcode are checked when it is generated, raising
+                `PickleValidationError` before it is written, and `max_stack_depth` is set when the payload is
+                output; this is not free, as opcode methods then take two to three times as long; data added with
+                `append_raw` must then consist of whole opcodes, and memo entries of `memo_allocator` are not tracked
 
         """
         if not isinstance(proto, int):
@@ -185,20 +280,603 @@ class PickleAssembler:
             raise ValueError('unsupported pickle protocol, must be in range [0, {}]'.format(HIGHEST_PROTOCOL))
         if not isinstance(verify, bool):
             raise TypeError('verify must be bool')
+        if not isinstance(ir, bool):
+            raise TypeError('ir must be bool')
+        if not isinstance(buffer_size, int):
+            raise TypeError('buffer size should be an integer')
+        if buffer_size <= 0:
+            raise ValueError('buffer size should be positive')
+        if batch_size is not None:
+            if not isinstance(batch_size, int):
+                raise TypeError('batch size should be an integer')
+            if batch_size <= 0:
+                raise ValueError('batch size should be positive')
+        if memoize not in (None, 'identity', 'equality'):
+            raise ValueError("memoize should be None, 'identity' or 'equality'")
+        if frame_size is not None:
+            if not isinstance(frame_size, int):
+                raise TypeError('frame size should be an integer')
+            if frame_size <= 0:
+                raise ValueError('frame size should be positive')
+            if proto < 4:
+                raise ValueError('framing requires protocol version >= 4')
+        if validate not in (None, 'assemble', 'incremental'):
+            raise ValueError("validate should be None, 'assemble' or 'incremental'")
+        if validate == 'assemble' and sink is not None:
+            raise ValueError("validate='assemble' cannot be used with a sink")
         self.proto = proto  # type: Final[int]
         self.verify = verify  # type: Final[bool]
-        self._payload = b''
+        self.batch_size = batch_size  # type: Final[Optional[int]]
+        self.memoize = memoize  # type: Final[Optional[str]]
+        self.frame_size = frame_size  # type: Final[Optional[int]]
+        self.validate = validate  # type: Final[Optional[str]]
+        # The maximum number of items on the unpickler stack, set when the payload is validated.
+        self.max_stack_depth = None  # type: Optional[int]
+        self._sink = sink  # type: Final[Optional[BinaryIO]]
+        self._buffer_size = buffer_size  # type: Final[int]
+        self._payload = bytearray()  # growable buffer, so that appending opcodes is amortized O(1)
+        # Segments of the payload before `_payload`, alternating between buffers (like `_payload`) and large arguments
+        # of opcodes, which are referenced rather than copied. Always empty when writing to a sink.
+        self._segments = []  # type: list[Buffer]
+        # The payload loaded by `from_bytes` (without STOP), its instructions, and replacements of them, keyed on the
+        # index of the first replaced instruction, with the index after the last one and the replacing opcodes.
+        self._loaded = None  # type: Optional[tuple[memoryview, list[Instruction], dict[int, tuple[int, bytes]]]]
+        # Whether the trailing STOP opcode has been written to the buffer by `view`, or to the sink by `assemble`.
+        self._stop_appended = False
+        # Offset in the buffer where the contents of the current frame start, or None if no frame is open. Unless
+        # writing to a sink, the buffer holds the FRAME opcode before it, whose size is filled in when needed.
+        self._frame_start = None  # type: Optional[int]
+        self.memo_allocator = MemoAllocator(self)  # type: Final[MemoAllocator]
+        # Out-of-band buffers pushed by `util_push`, to be passed to the unpickler along with the payload.
+        self.buffers = []  # type: Final[list[object]]
+        # Memo of `util_push`, mapping memo keys of objects to their handles in `memo_allocator` and the objects
+        # themselves (to keep them alive, so that their ids are not reused).
+        self._util_memo = {} if memoize else None  # type: Optional[dict[Hashable, tuple[int, object]]]
+        # The model of the unpickler stack updated by opcode methods, which are wrapped to do so by the class of the
+        # assembler (see `_validating_methods`).
+        self._stack_model = _StackModel() if validate == 'incremental' else None
+        self._write = self._payload.extend if sink is None else self._write_to_sink  # type: Callable[[bytes], None]
         if proto >= 2:
-            self._payload += PROTO + p8(proto)
+            self._write(_pack_opcode_u8(PROTO, proto))  # kept out of frames, and not recorded in `ir`
+        self.ir = PickleIR() if ir else None  # type: Final[Optional[PickleIR]]
+        if self.ir is not None:
+            self.ir._memo_allocator = self.memo_allocator  # pylint: disable=protected-access
+        self._recording = ir  # whether `_write` records instructions in `ir` rather than encoding them
+        self._ir_lowered = 0  # number of instructions in `ir` which have been encoded into the payload
+        self._bind_write()
+
+    def __copy__(self) -> 'PickleAssembler':
+        # Copies share no buffer with the assembler, so that a template can be copied and extended without modifying
+        # it. The objects given to the assembler (referenced arguments, out-of-band buffers and memoized objects) are
+        # shared rather than copied, also by `copy.deepcopy`.
+        if self._sink is not None:
+            raise TypeError('cannot copy an assembler writing to a sink')
+        state = self.__getstate__()
+        state.update(
+            _payload=bytearray(self._payload),
+            _segments=list(self._segments),
+            memo_allocator=copy.deepcopy(self.memo_allocator),
+            buffers=list(self.buffers),
+            _util_memo=None if self._util_memo is None else dict(self._util_memo),
+            _stack_model=copy.deepcopy(self._stack_model),
+        )
+        if self._loaded is not None:
+            view, instructions, replacements = self._loaded
+            state['_loaded'] = view, instructions, dict(replacements)
+        other = _new_assembler(_protocol_class(type(self), None), self.proto, self.verify, self.validate)
+        other.__setstate__(state)
+        return other
+
+    def __deepcopy__(self, memo: 'dict[int, object]') -> 'PickleAssembler':
+        return self.__copy__()
+
+    def __reduce__(self) -> 'tuple[object, ...]':
+        # The class specialized for the protocol (see `__new__`) cannot be pickled by reference, so the assembler is
+        # created again from the class it specializes.
+        args = _protocol_class(type(self), None), self.proto, self.verify, self.validate
+        return _new_assembler, args, self.__getstate__()
+
+    def __getstate__(self) -> 'dict[str, object]':
+        # The method bound on the instance is bound again by `__setstate__`.
+        state = dict(self.__dict__)
+        del state['_write']
+        if self.ir is not None:
+            # The placeholders of `memo_allocator` are kept, and filled in by the allocator of the new assembler.
+            state['ir'] = self.ir._copy()  # pylint: disable=protected-access
+        return state
+
+    def __setstate__(self, state: 'dict[str, object]') -> None:
+        self.__dict__.update(state)
+        self.memo_allocator._assembler = weakref.proxy(self)  # pylint: disable=protected-access
+        if self.ir is not None:
+            self.ir._memo_allocator = self.memo_allocator  # pylint: disable=protected-access
+        if self._util_memo:
+            # Objects memoized by identity are keyed on their ids, which change when they are copied.
+            self._util_memo = {
+                key if isinstance(key, tuple) else id(value): (handle, value)
+                for key, (handle, value) in self._util_memo.items()
+            }
+        self._bind_write()
 
     def assemble(self) -> bytes:
         """Assemble pickle payload.
 
+        If the assembler writes to a sink, the ``STOP`` opcode is written and all buffered data is flushed to the sink.
+        The pickle is then finished: later calls return without writing anything, and generating further opcodes
+        raises `ValueError`.
+
+        Returns:
+            the generated pickle payload, or an empty bytes object if the payload has been written to the sink
+
+        """
+        if self._sink is not None and self._stop_appended:
+            return b''
+        self._lower_ir()
+        if self._sink is not None:
+            self._validate_payload([])
+            self._payload += STOP
+            self._flush_to_sink()
+            if hasattr(self._sink, 'flush'):
+                self._sink.flush()
+            self._stop_appended = True
+            self._bind_write()
+            return b''
+        self._resolve_memo()
+        self._fill_frame_size(not self._stop_appended)
+        if self._stop_appended:
+            result = bytes(self._payload)
+        else:
+            result = b''.join(self._all_segments() + [STOP])
+        self._validate_payload([result])
+        return result
+
+    def view(self) -> memoryview:
+        """Get a read-only view of the assembled pickle payload without copying it.
+
+        The view shares memory with the assembler, so it must be released (e.g. by using it in a ``with``
+        statement) before the assembler is modified again. On Python < 3.8, the returned view is writable.
+
+        Large arguments referenced by the payload (see ``buffer_size`` of `__init__`) and the payload loaded by
+        `from_bytes` are copied into the assembler first, since the view has to be contiguous. Loaded instructions
+        can no longer be replaced afterwards.
+
+        Returns:
+            a memoryview of the generated pickle payload, including the trailing ``STOP`` opcode
+
+        """
+        if self._sink is not None:
+            raise ValueError('payload is not kept in memory when writing to a sink')
+        self._lower_ir()
+        self._resolve_memo()
+        if self._segments or self._loaded is not None:
+            tail_size = len(self._payload)
+            self._payload = bytearray().join(self._all_segments())
+            self._segments = []
+            self._loaded = None
+            if self._frame_start is not None:
+                self._frame_start += len(self._payload) - tail_size
+            self._bind_write()
+        if not self._stop_appended:
+            self._payload += STOP
+            self._stop_appended = True
+            self._bind_write()
+        self._fill_frame_size(0)
+        self._validate_payload([self._payload])
+        view = memoryview(self._payload)
+        return view.toreadonly() if hasattr(view, 'toreadonly') else view  # toreadonly() is new in Python 3.8
+
+    def assemble_into(self, buf: 'bytearray | memoryview', offset: int = 0) -> int:
+        """Assemble pickle payload into a caller-supplied writable buffer.
+
+        Args:
+            buf: the writable buffer to write the generated pickle payload into
+            offset: the position in ``buf`` to start writing at
+
+        Returns:
+            the position in ``buf`` right after the written payload
+
+        """
+        if self._sink is not None:
+            raise ValueError('payload is not kept in memory when writing to a sink')
+        if not isinstance(offset, int):
+            raise TypeError('offset should be an integer')
+        self._lower_ir()
+        self._resolve_memo()
+        self._fill_frame_size(not self._stop_appended)
+        segments = self._all_segments()
+        self._validate_payload(segments if self._stop_appended else segments + [STOP])
+        length = sum(map(len, segments))  # type: ignore[arg-type]
+        with memoryview(buf) as target:
+            if target.readonly:
+                raise TypeError('buffer should be writable')
+            if offset < 0 or offset + length + (not self._stop_appended) > target.nbytes:
+                raise ValueError('buffer too small to hold the assembled payload')
+            with target.cast('B') as target_bytes:
+                for segment in segments:
+                    target_bytes[offset:offset + len(segment)] = segment  # type: ignore[arg-type]
+                    offset += len(segment)  # type: ignore[arg-type]
+                if not self._stop_appended:
+                    target_bytes[offset] = STOP[0]
+                    offset += 1
+        return offset
+
+    def write_to_fd(self, fd: int) -> int:
+        """Write the assembled pickle payload to a file descriptor.
+
+        The segments of the payload are written with vectored I/O (``os.writev``, where available), without joining
+        them into a single bytes object first.
+
+        Args:
+            fd: the file descriptor to write to, which should be in blocking mode
+
+        Returns:
+            the number of bytes written
+
+        """
+        if not isinstance(fd, int):
+            raise TypeError('file descriptor should be an integer')
+        if _writev is None:  # pragma: no cover
+            return self._write_vectored(lambda buffers: os.write(fd, buffers[0]))
+        return self._write_vectored(functools.partial(_writev, fd))
+
+    def send_to_socket(self, sock: 'socket.socket') -> int:
+        """Send the assembled pickle payload over a socket.
+
+        The segments of the payload are sent with vectored I/O (``socket.sendmsg``, where available), without joining
+        them into a single bytes object first.
+
+        Args:
+            sock: the connected socket to send to, which should be in blocking mode
+
+        Returns:
+            the number of bytes sent
+
+        """
+        if not hasattr(sock, 'sendmsg'):  # pragma: no cover
+            return self._write_vectored(lambda buffers: sock.send(buffers[0]))
+        return self._write_vectored(sock.sendmsg)
+
+    def _write_vectored(self, write: 'Callable[[list[memoryview]], int]') -> int:
+        # Write the payload with `write`, which writes a prefix of the given buffers and returns its size.
+        if self._sink is not None:
+            raise ValueError('payload is not kept in memory when writing to a sink')
+        self._lower_ir()
+        self._resolve_memo()
+        self._fill_frame_size(not self._stop_appended)
+        segments = self._all_segments() if self._stop_appended else self._all_segments() + [STOP]
+        self._validate_payload(segments)
+        views = [memoryview(segment) for segment in segments if len(segment)]  # type: ignore[arg-type]
+        total = 0
+        index = 0
+        while index < len(views):
+            size = write(views[index:index + _IOV_MAX])
+            total += size
+            while index < len(views) and size >= len(views[index]):
+                size -= len(views[index])
+                index += 1
+            if size:
+                views[index] = views[index][size:]
+        return total
+
+    def _validate_payload(self, segments: 'list[Buffer]') -> None:
+        # Check the stack effects of the payload given by its segments (including STOP), if requested.
+        if self._stack_model is not None:
+            self._stack_model.check_pops(1, STOP[0])
+            self.max_stack_depth = self._stack_model.max_total
+        elif self.validate == 'assemble':
+            if len(segments) == 1 and isinstance(segments[0], (bytes, bytearray)):
+                data = segments[0]
+            else:
+                data = b''.join(segments)
+            self.max_stack_depth = _simulate(data)
+
+    def _write_after_view(self, data: bytes) -> None:
+        try:
+            del self._payload[-1]  # remove the STOP opcode appended by `view`
+        except BufferError:
+            raise BufferError('the memoryview returned by view() must be released '
+                              'before modifying the assembler') from None
+        self._stop_appended = False
+        self._bind_write()
+        self._write(data)
+
+    @classmethod
+    def from_bytes(cls, data: 'Buffer', verify: bool = True) -> 'PickleAssembler':
+        """Create a pickle assembler starting with an existing pickle payload, for editing it.
+
+        The payload is disassembled (see `disassemble`) and referenced rather than copied. New opcodes are generated
+        after its last opcode before ``STOP``, and its instructions (`loaded_instructions`) can be replaced with
+        `replace_loaded`; only the replaced instructions (and the headers of frames containing them) are changed
+        when the payload is assembled.
+
+        The protocol version is taken from the ``PROTO`` opcode of the payload, or else is the highest protocol
+        among its opcodes. `memo_allocator` gives new memo entries indices after those stored by the payload.
+
+        Args:
+            data: the pickle payload to load
+            verify: whether to check opcodes against the protocol number
+
         Returns:
-            the generated pickle payload
+            a new pickle assembler
 
         """
-        return self._payload + STOP
+        view = memoryview(_as_bytes_like(data))
+        instructions = disassemble(view)
+        if instructions[0].opcode is PROTO:
+            proto = cast(int, instructions[0].arg)
+        else:
+            proto = max(cast(Opcode, instruction.opcode).proto for instruction in instructions)
+        assembler = cls(proto=proto, verify=verify)
+        del assembler._payload[:]  # the protocol header, if any, is part of the loaded payload
+        memo = set()  # type: set[int]
+        for instruction in instructions:
+            if instruction.opcode is MEMOIZE:
+                memo.add(len(memo))
+            elif instruction.opcode is PUT or instruction.opcode is BINPUT or instruction.opcode is LONG_BINPUT:
+                memo.add(cast(int, instruction.arg))
+        assembler.memo_allocator._load_indices(memo)  # pylint: disable=protected-access
+        stop = instructions.pop()
+        assembler._loaded = view[:stop.pos], instructions, {}
+        return assembler
+
+    @property
+    def loaded_instructions(self) -> 'list[Instruction]':
+        """The instructions of the payload loaded by `from_bytes`, without the final ``STOP`` (not to be modified)."""
+        return [] if self._loaded is None else self._loaded[1]
+
+    @contextlib.contextmanager
+    def replace_loaded(self, start: int, stop: 'Optional[int]' = None) -> 'Iterator[None]':
+        """Replace instructions of the payload loaded by `from_bytes` with the opcodes generated in a ``with`` block.
+
+        For example, ``with assembler.replace_loaded(3): assembler.push_global('os', 'system')`` replaces the fourth
+        loaded instruction with a ``GLOBAL`` opcode.
+
+        Args:
+            start: the index of the first instruction to replace in `loaded_instructions`
+            stop: the index after the last instruction to replace, ``start + 1`` by default; if equal to ``start``,
+                the opcodes are inserted before the instruction at ``start``
+
+        """
+        if self._loaded is None:
+            raise ValueError('no loaded payload to replace')
+        _, instructions, replacements = self._loaded
+        if not isinstance(start, int) or not isinstance(stop, (int, type(None))):
+            raise TypeError('instruction indices should be integers')
+        if stop is None:
+            stop = start + 1
+        if not 0 <= start <= stop <= len(instructions):
+            raise IndexError('instruction index out of range')
+        for other_start, (other_stop, _) in replacements.items():
+            if start == other_start or start < other_stop and other_start < stop:
+                raise ValueError('instructions have already been replaced')
+        saved = self._payload, self._segments
+        self._payload = bytearray()
+        self._segments = []
+        self._bind_write()
+        try:
+            yield
+            replacement = b''.join(self._segments + [self._payload])
+        finally:
+            self._payload, self._segments = saved
+            self._bind_write()
+        replacements[start] = stop, replacement
+
+    def optimize(self) -> int:
+        """Rewrite wasteful opcode sequences of the payload generated so far into shorter equivalents.
+
+        The instructions are rewritten in a single pass, as follows:
+
+        - ``MARK``, 1 to 3 items and ``TUPLE`` become the items and ``TUPLE1`` / ``TUPLE2`` / ``TUPLE3`` (with
+          protocol 2 or above), and ``MARK TUPLE`` becomes ``EMPTY_TUPLE`` (with protocol 1 or above)
+        - ``PUT``, ``BINPUT`` and ``LONG_BINPUT`` opcodes storing memo entries which are never fetched are removed,
+          unless they are followed by ``MEMOIZE`` (which stores at the size of the memo) or raw data has been appended
+        - ``DUP`` directly followed by ``POP`` is removed
+
+        Removed memo entries can no longer be fetched, so their handles in `memo_allocator` become invalid, and
+        `util_push` pushes their objects again. With ``ir=True``, the recorded instructions are rewritten; otherwise
+        the payload (including one loaded by `from_bytes`) is disassembled and generated again, and the frames of
+        a loaded payload are only kept if ``frame_size`` is given.
+
+        Returns:
+            the number of bytes saved
+
+        """
+        if self.ir is not None:
+            if self._ir_lowered:
+                if self._sink is not None:
+                    raise ValueError('payload has already been written to the sink')
+                self._reset_payload(_pack_opcode_u8(PROTO, self.proto) if self.proto >= 2 else b'')
+            self.ir._fill_memo()  # pylint: disable=protected-access
+            encodings = self.ir._encodings  # pylint: disable=protected-access
+            old_size = _encodings_size(encodings)
+            encodings[:], removed = _optimize_instructions(self.ir.codes, encodings, self.proto)
+            del self.ir._codes[:]  # pylint: disable=protected-access
+            saved = old_size - _encodings_size(encodings)
+        else:
+            if self._sink is not None:
+                raise ValueError('payload is not kept in memory when writing to a sink')
+            self._resolve_memo()
+            self._fill_frame_size(not self._stop_appended)
+            segments = self._all_segments()
+            data = b''.join(segments if self._stop_appended else segments + [STOP])
+            header = data[:2] if data[:1] == PROTO else b''
+            codes, encodings = _split_opcodes(data, len(header))
+            encodings, removed = _optimize_instructions(codes, encodings, self.proto)
+            self._reset_payload(header)
+            self._write_encodings(encodings)
+            saved = len(data) - 1 - sum(map(len, self._segments)) - len(self._payload)  # type: ignore[arg-type]
+        if removed:
+            if self._stack_model is not None:
+                self._stack_model.memo -= removed
+            handles = self.memo_allocator._remove_indices(removed)  # pylint: disable=protected-access
+            if self._util_memo:
+                self._util_memo = {key: entry for key, entry in self._util_memo.items() if entry[0] not in handles}
+        return saved
+
+    def _all_segments(self) -> 'list[Buffer]':
+        # The segments of the whole payload, with replacements of loaded instructions applied.
+        if self._loaded is None:
+            return self._segments + [self._payload]
+        view, instructions, replacements = self._loaded
+        size = len(view)
+        # Each change replaces the part of the loaded payload between two positions.
+        changes = []  # type: list[tuple[int, int, bytes]]
+        for start, (stop, replacement) in replacements.items():
+            changes.append((instructions[start].pos if start < len(instructions) else size,
+                            instructions[stop].pos if stop < len(instructions) else size, replacement))
+        # Frames are resized by the changes inside them, and by the removal of STOP if opcodes are generated after
+        # the loaded payload (otherwise STOP is written back to where it was).
+        frames = [instruction for instruction in instructions if instruction.opcode is FRAME]
+        frame_starts = [frame.pos + 9 for frame in frames]
+        resizes = [0] * len(frames)
+        stop_removal = [(size, size + 1, b'')] if self._segments or self._payload else []
+        for start_pos, stop_pos, replacement in changes + stop_removal:
+            index = bisect.bisect_right(frame_starts, start_pos) - 1
+            if index >= 0 and start_pos < frame_starts[index] + cast(int, frames[index].arg):
+                resizes[index] += len(replacement) - (stop_pos - start_pos)
+        replaced = {start_pos for start_pos, stop_pos, _ in changes if stop_pos > start_pos}
+        for frame, resize in zip(frames, resizes):
+            if resize and frame.pos not in replaced:
+                changes.append((frame.pos, frame.pos + 9, _pack_opcode_u64(FRAME, cast(int, frame.arg) + resize)))
+        segments = []  # type: list[Buffer]
+        position = 0
+        for start_pos, stop_pos, replacement in sorted(changes):
+            segments += (view[position:start_pos], replacement)
+            position = stop_pos
+        segments.append(view[position:])
+        return segments + self._segments + [self._payload]
+
+    def _payload_position(self) -> 'tuple[int, int]':
+        return len(self._segments), len(self._payload) - self._stop_appended
+
+    def _resolve_memo(self) -> None:
+        # Fill in the memo opcodes of `memo_allocator` whose indices have not been picked yet.
+        if self.memo_allocator.pending:
+            segments = self._segments + [self._payload]
+            self.memo_allocator.resolve(segments)
+            self._payload = cast(bytearray, segments.pop())
+            self._segments = segments
+            self._bind_write()
+
+    def _lower_ir(self) -> None:
+        # Encode the instructions recorded in `ir` since the last call into the payload.
+        ir = self.ir
+        if ir is None or self._ir_lowered == len(ir):
+            return
+        ir._fill_memo()  # pylint: disable=protected-access
+        self._recording = False
+        self._bind_write()
+        try:
+            encodings = ir._encodings  # pylint: disable=protected-access
+            self._write_encodings(itertools.islice(encodings, self._ir_lowered, None))
+        finally:
+            self._recording = True
+            self._ir_lowered = len(ir)
+            self._bind_write()
+
+    def _write_encodings(self, encodings: 'Iterable[_Encoding]') -> None:
+        # Write instructions given by their encodings, as recorded in `PickleIR`.
+        for encoding in encodings:
+            # `_write` is looked up each time, as it is rebound when a large argument starts a new segment.
+            if isinstance(encoding, tuple):
+                self._write(encoding[0])  # type: ignore[arg-type]
+                for piece in encoding[1:]:
+                    self._write_large(piece)
+            else:
+                self._write(encoding)
+
+    def _reset_payload(self, header: bytes) -> None:
+        # Start the payload over with the given protocol header.
+        self._payload = bytearray(header)
+        self._segments = []
+        self._loaded = None
+        self._frame_start = None
+        self._stop_appended = False
+        self._ir_lowered = 0
+        self._bind_write()
+
+    def _bind_write(self) -> None:
+        if self._stop_appended:
+            self._write = self._write_after_view if self._sink is None else self._write_after_stop
+        elif self._recording:
+            self._write = cast(PickleIR, self.ir)._encodings.append  # pylint: disable=protected-access
+        elif self.frame_size is not None:
+            self._write = self._write_framed
+        elif self._sink is not None:
+            self._write = self._write_to_sink
+        else:
+            self._write = self._payload.extend
+
+    def _write_after_stop(self, data: bytes) -> None:
+        raise ValueError('payload has already been written to the sink')
+
+    def _write_to_sink(self, data: bytes) -> None:
+        self._payload += data
+        if len(self._payload) >= self._buffer_size:
+            self._flush_to_sink()
+
+    def _write_framed(self, data: bytes) -> None:
+        # `_write` is called at the start of each opcode, which is the only place where a frame may end, as the
+        # unpickler cannot read an opcode across frames.
+        if self._frame_start is None or len(self._payload) - self._frame_start >= cast(int, self.frame_size):
+            self._end_frame()
+            if self._sink is None:
+                self._payload += _FRAME_HEADER_PLACEHOLDER
+            self._frame_start = len(self._payload)
+        self._payload += data
+
+    def _end_frame(self) -> None:
+        if self._sink is not None:
+            self._flush_to_sink()
+        else:
+            self._fill_frame_size(0)
+            self._frame_start = None
+
+    def _fill_frame_size(self, trailing: int) -> None:
+        # Fill in the size of the current frame in memory, counting ``trailing`` bytes to be written after the buffer.
+        if self._frame_start is not None:
+            _pack_u64_into(self._payload, self._frame_start - 8, len(self._payload) - self._frame_start + trailing)
+
+    def _write_large(self, data: 'bytes | memoryview') -> None:
+        # Write the argument of the opcode being written. Large data is kept out of frames, and is written to the sink
+        # directly or referenced by the payload as a segment of its own, rather than copied into the buffer.
+        if self._recording:
+            encodings = cast(PickleIR, self.ir)._encodings  # pylint: disable=protected-access
+            last = encodings[-1]
+            encodings[-1] = last + (data,) if isinstance(last, tuple) else (last, data)
+            return
+        if self.frame_size is not None:
+            if len(data) < self.frame_size:
+                self._payload += data  # within the current frame
+                return
+            self._end_frame()
+        elif len(data) < self._buffer_size:
+            self._write(data)  # type: ignore[arg-type]
+            return
+        if self._sink is not None:
+            self._flush_to_sink()
+            self._sink.write(data)
+        elif len(data) < self._buffer_size:
+            self._payload += data
+        else:
+            self._segments += (self._payload, data)
+            self._payload = bytearray()
+            self._bind_write()
+
+    def _flush_to_sink(self) -> None:
+        sink = cast('BinaryIO', self._sink)
+        start = self._frame_start
+        if start is not None:
+            # The FRAME opcode is written along with the unframed data before the frame, if any.
+            sink.write(self._payload[:start] + _pack_opcode_u64(FRAME, len(self._payload) - start))
+            with memoryview(self._payload) as view:
+                sink.write(view[start:])
+            self._frame_start = None
+        elif self._payload:
+            sink.write(self._payload)
+        else:
+            return
+        self._payload = bytearray()  # the sink may keep the old buffer (or a view of it) rather than copy it
 
     def append_raw(self, data: bytes) -> None:
         """Append raw opcode data to the current pickle assembler.
@@ -209,22 +887,27 @@ class PickleAssembler:
         """
         if not isinstance(data, bytes):
             raise TypeError('raw data must be bytes')
-        self._payload += data
+        if self._stack_model is not None:
+            self._stack_model.feed(data)
+        if self.ir is None:
+            self._write(data)
+        elif data:
+            self._write(_RawData(data))  # not necessarily a single opcode
 
     def push_none(self) -> None:
-        self._payload += NONE
+        self._write(NONE)
 
     def push_false(self) -> None:
-        self._payload += NEWFALSE
+        self._write(NEWFALSE)
 
     def push_true(self) -> None:
-        self._payload += NEWTRUE
+        self._write(NEWTRUE)
 
     def push_int(self, value: 'bool | int') -> None:
         if isinstance(value, bool):
-            self._payload += [FALSE, TRUE][value]
+            self._write([FALSE, TRUE][value])
         elif isinstance(value, int):
-            self._payload += INT + str(value).encode('ascii') + b'\n'
+            self._write(INT + str(value).encode('ascii') + b'\n')
         else:
             raise TypeError('value should be an integer or bool')
 
@@ -233,57 +916,57 @@ class PickleAssembler:
             raise TypeError('value should be an integer')
         if not - 2 ** 31 <= value <= 2 ** 31 - 1:
             raise ValueError('integer out of range for opcode BININT')
-        self._payload += BININT + p32(value, signed=True)
+        self._write(_pack_opcode_i32(BININT, value))
 
     def push_binint1(self, value: int) -> None:
         if not isinstance(value, int):
             raise TypeError('value should be an integer')
         if not 0 <= value <= 2 ** 8 - 1:
             raise ValueError('integer out of range for opcode BININT1')
-        self._payload += BININT1 + p8(value)
+        self._write(_pack_opcode_u8(BININT1, value))
 
     def push_binint2(self, value: int) -> None:
         if not isinstance(value, int):
             raise TypeError('value should be an integer')
         if not 0 <= value <= 2 ** 16 - 1:
             raise ValueError('integer out of range for opcode BININT2')
-        self._payload += BININT2 + p16(value)
+        self._write(_pack_opcode_u16(BININT2, value))
 
     def push_long(self, value: int) -> None:
         if not isinstance(value, int):
             raise TypeError('value should be an integer')
-        self._payload += LONG + str(value).encode('ascii') + b'\n'
+        self._write(LONG + str(value).encode('ascii') + b'\n')
 
     def push_long1(self, value: int) -> None:
         if not isinstance(value, int):
             raise TypeError('value should be an integer')
-        value_bytes = pack(value, endian='<', signed=True)
+        value_bytes = _encode_long(value)
         if len(value_bytes) >= 2 ** 8:
             raise ValueError('integer too long for opcode LONG1')
-        self._payload += LONG1 + p8(len(value_bytes)) + value_bytes
+        self._write(_pack_opcode_u8(LONG1, len(value_bytes)) + value_bytes)
 
     def push_long4(self, value: int) -> None:
         if not isinstance(value, int):
             raise TypeError('value should be an integer')
-        value_bytes = pack(value, endian='<', signed=True)
+        value_bytes = _encode_long(value)
         if len(value_bytes) >= 2 ** 31:  # pragma: no cover
             raise ValueError('integer too long for opcode LONG4')
-        self._payload += LONG4 + p32(len(value_bytes), signed=True) + value_bytes
+        self._write(_pack_opcode_i32(LONG4, len(value_bytes)) + value_bytes)
 
     def push_float(self, value: float) -> None:
         if not isinstance(value, float):
             raise TypeError('value should be a float')
-        self._payload += FLOAT + str(value).encode('ascii') + b'\n'
+        self._write(FLOAT + str(value).encode('ascii') + b'\n')
 
     def push_binfloat(self, value: float) -> None:
         if not isinstance(value, float):
             raise TypeError('value should be a float')
-        self._payload += BINFLOAT + struct.pack('>d', value)
+        self._write(_pack_opcode_f64(BINFLOAT, value))
 
     def push_string(self, value: str, encoding: str = 'ascii') -> None:
         if not isinstance(value, str):
             raise TypeError('value should be str')
-        self._payload += STRING + ascii(value).encode(encoding) + b'\n'
+        self._write(STRING + ascii(value).encode(encoding) + b'\n')
 
     def push_binstring(self, value: str, encoding: str = 'ascii') -> None:
         if not isinstance(value, str):
@@ -291,7 +974,8 @@ class PickleAssembler:
         value_bytes = value.encode(encoding)
         if len(value_bytes) >= 2 ** 31:  # pragma: no cover
             raise ValueError('string too long for opcode BINSTRING')
-        self._payload += BINSTRING + p32(len(value_bytes), signed=True) + value_bytes
+        self._write(_pack_opcode_i32(BINSTRING, len(value_bytes)))
+        self._write_large(value_bytes)
 
     def push_short_binstring(self, value: str, encoding: str = 'ascii') -> None:
         if not isinstance(value, str):
@@ -299,35 +983,37 @@ class PickleAssembler:
         value_bytes = value.encode(encoding)
         if len(value_bytes) >= 2 ** 8:
             raise ValueError('string too long for opcode SHORT_BINSTRING')
-        self._payload += SHORT_BINSTRING + p8(len(value_bytes)) + value_bytes
+        self._write(_pack_opcode_u8(SHORT_BINSTRING, len(value_bytes)) + value_bytes)
 
-    def push_binbytes(self, value: bytes) -> None:
-        if not isinstance(value, bytes):
-            raise TypeError('value should be bytes')
+    def push_binbytes(self, value: 'Buffer') -> None:
+        value = _as_bytes_like(value)
         if len(value) >= 2 ** 32:  # pragma: no cover
             raise ValueError('bytes too long for opcode BINBYTES')
-        self._payload += BINBYTES + p32(len(value)) + value
+        self._write(_pack_opcode_u32(BINBYTES, len(value)))
+        self._write_large(value)
 
-    def push_binbytes8(self, value: bytes) -> None:
-        if not isinstance(value, bytes):
-            raise TypeError('value should be bytes')
+    def push_binbytes8(self, value: 'Buffer') -> None:
+        value = _as_bytes_like(value)
         if len(value) >= 2 ** 64:  # pragma: no cover
             raise ValueError('bytes too long for opcode BINBYTES8')
-        self._payload += BINBYTES8 + p64(len(value)) + value
+        self._write(_pack_opcode_u64(BINBYTES8, len(value)))
+        self._write_large(value)
 
-    def push_short_binbytes(self, value: bytes) -> None:
-        if not isinstance(value, bytes):
-            raise TypeError('value should be bytes')
+    def push_short_binbytes(self, value: 'Buffer') -> None:
+        value = _as_bytes_like(value)
         if len(value) >= 2 ** 8:
             raise ValueError('bytes too long for opcode SHORT_BINBYTES')
-        self._payload += SHORT_BINBYTES + p8(len(value)) + value
+        self._write(_pack_opcode_u8(SHORT_BINBYTES, len(value)) + value)
 
-    def push_bytearray8(self, value: 'bytes | bytearray') -> None:
-        if not isinstance(value, (bytes, bytearray)):
-            raise TypeError('value should be bytes or bytearray')
+    def push_bytearray8(self, value: 'Buffer') -> None:
+        value = _as_bytes_like(value)
         if len(value) >= 2 ** 64:  # pragma: no cover
             raise ValueError('bytes too long for opcode BYTEARRAY8')
-        self._payload += BYTEARRAY8 + p64(len(value)) + value
+        self._write(_pack_opcode_u64(BYTEARRAY8, len(value)))
+        self._write_large(value)
+
+    def push_next_buffer(self) -> None:
+        self._write(NEXT_BUFFER)
 
     def push_unicode(self, value: str) -> None:
         if not isinstance(value, str):
@@ -337,168 +1023,182 @@ class PickleAssembler:
         value = value.replace('\n', '\\u000a')
         value = value.replace('\r', '\\u000d')
         value = value.replace('\x1a', '\\u001a')
-        self._payload += UNICODE + value.encode('raw-unicode-escape') + b'\n'
+        # str.replace() leaves the string as is if the character is absent, and a chain of replace() calls is
+        # considerably faster than a single pass of str.translate() or re.sub() with multi-character replacements.
+        self._write(UNICODE)
+        self._write_large(value.encode('raw-unicode-escape'))
+        self._write_large(b'\n')  # still part of the same opcode
 
     def push_binunicode(self, value: str) -> None:
         if not isinstance(value, str):
             raise TypeError('value should be str')
-        value_bytes = value.encode('utf-8', 'surrogatepass')
-        if len(value_bytes) >= 2 ** 32:  # pragma: no cover
-            raise ValueError('string too long for opcode BINUNICODE')
-        self._payload += BINUNICODE + p32(len(value_bytes)) + value_bytes
+        self._push_binunicode_encoded(value.encode('utf-8', 'surrogatepass'))
 
     def push_binunicode8(self, value: str) -> None:
         if not isinstance(value, str):
             raise TypeError('value should be str')
-        value_bytes = value.encode('utf-8', 'surrogatepass')
-        if len(value_bytes) >= 2 ** 64:  # pragma: no cover
-            raise ValueError('string too long for opcode BINUNICODE8')
-        self._payload += BINUNICODE8 + p64(len(value_bytes)) + value_bytes
+        self._push_binunicode8_encoded(value.encode('utf-8', 'surrogatepass'))
 
     def push_short_binunicode(self, value: str) -> None:
         if not isinstance(value, str):
             raise TypeError('value should be str')
-        value_bytes = value.encode('utf-8', 'surrogatepass')
+        self._push_short_binunicode_encoded(value.encode('utf-8', 'surrogatepass'))
+
+    # The following methods take the UTF-8 encoded string, so that callers which already encoded the string
+    # (e.g. to choose the opcode by its length) do not have to encode it again.
+
+    def _push_binunicode_encoded(self, value_bytes: bytes) -> None:
+        if len(value_bytes) >= 2 ** 32:  # pragma: no cover
+            raise ValueError('string too long for opcode BINUNICODE')
+        self._write(_pack_opcode_u32(BINUNICODE, len(value_bytes)))
+        self._write_large(value_bytes)
+
+    def _push_binunicode8_encoded(self, value_bytes: bytes) -> None:
+        if len(value_bytes) >= 2 ** 64:  # pragma: no cover
+            raise ValueError('string too long for opcode BINUNICODE8')
+        self._write(_pack_opcode_u64(BINUNICODE8, len(value_bytes)))
+        self._write_large(value_bytes)
+
+    def _push_short_binunicode_encoded(self, value_bytes: bytes) -> None:
         if len(value_bytes) >= 2 ** 8:
             raise ValueError('string too long for opcode SHORT_BINUNICODE')
-        self._payload += SHORT_BINUNICODE + p8(len(value_bytes)) + value_bytes
+        self._write(_pack_opcode_u8(SHORT_BINUNICODE, len(value_bytes)) + value_bytes)
 
     def push_empty_tuple(self) -> None:
-        self._payload += EMPTY_TUPLE
+        self._write(EMPTY_TUPLE)
 
     def push_empty_list(self) -> None:
-        self._payload += EMPTY_LIST
+        self._write(EMPTY_LIST)
 
     def push_empty_dict(self) -> None:
-        self._payload += EMPTY_DICT
+        self._write(EMPTY_DICT)
 
     def push_empty_set(self) -> None:
-        self._payload += EMPTY_SET
+        self._write(EMPTY_SET)
 
     def push_global(self, module: str, name: str) -> None:
         if not isinstance(module, str) or not isinstance(name, str):
             raise TypeError('module and name should be str')
-        self._payload += GLOBAL
-        self._payload += module.encode('utf-8') + b'\n'
-        self._payload += name.encode('utf-8') + b'\n'
+        self._write(GLOBAL + module.encode('utf-8') + b'\n' + name.encode('utf-8') + b'\n')
 
     def push_mark(self) -> None:
-        self._payload += MARK
+        self._write(MARK)
 
     def build_tuple(self) -> None:
-        self._payload += TUPLE
+        self._write(TUPLE)
 
     def build_tuple1(self) -> None:
-        self._payload += TUPLE1
+        self._write(TUPLE1)
 
     def build_tuple2(self) -> None:
-        self._payload += TUPLE2
+        self._write(TUPLE2)
 
     def build_tuple3(self) -> None:
-        self._payload += TUPLE3
+        self._write(TUPLE3)
 
     def build_list(self) -> None:
-        self._payload += LIST
+        self._write(LIST)
 
     def build_dict(self) -> None:
-        self._payload += DICT
+        self._write(DICT)
 
     def build_frozenset(self) -> None:
-        self._payload += FROZENSET
+        self._write(FROZENSET)
 
     def build_append(self) -> None:
-        self._payload += APPEND
+        self._write(APPEND)
 
     def build_appends(self) -> None:
-        self._payload += APPENDS
+        self._write(APPENDS)
 
     def build_setitem(self) -> None:
-        self._payload += SETITEM
+        self._write(SETITEM)
 
     def build_setitems(self) -> None:
-        self._payload += SETITEMS
+        self._write(SETITEMS)
 
     def build_additems(self) -> None:
-        self._payload += ADDITEMS
+        self._write(ADDITEMS)
 
     def build_inst(self, module: str, name: str) -> None:
         if not isinstance(module, str) or not isinstance(name, str):
             raise TypeError('module and name should be str')
-        self._payload += INST
-        self._payload += module.encode('ascii') + b'\n'
-        self._payload += name.encode('ascii') + b'\n'
+        self._write(INST + module.encode('ascii') + b'\n' + name.encode('ascii') + b'\n')
+
+    def build_readonly_buffer(self) -> None:
+        self._write(READONLY_BUFFER)
 
     def build_obj(self) -> None:
-        self._payload += OBJ
+        self._write(OBJ)
 
     def build_newobj(self) -> None:
-        self._payload += NEWOBJ
+        self._write(NEWOBJ)
 
     def build_newobj_ex(self) -> None:
-        self._payload += NEWOBJ_EX
+        self._write(NEWOBJ_EX)
 
     def build_stack_global(self) -> None:
-        self._payload += STACK_GLOBAL
+        self._write(STACK_GLOBAL)
 
     def build_reduce(self) -> None:
-        self._payload += REDUCE
+        self._write(REDUCE)
 
     def build_build(self) -> None:
-        self._payload += BUILD
+        self._write(BUILD)
 
     def build_dup(self) -> None:
-        self._payload += DUP
+        self._write(DUP)
 
     def pop(self) -> None:
-        self._payload += POP
+        self._write(POP)
 
     def pop_mark(self) -> None:
-        self._payload += POP_MARK
+        self._write(POP_MARK)
 
     def memo_get(self, index: int) -> None:
         if not isinstance(index, int):
             raise TypeError('memo index should be an integer')
         if index < 0:
             raise ValueError('memo index should be non-negative')
-        self._payload += GET + str(index).encode('ascii') + b'\n'
+        self._write(GET + str(index).encode('ascii') + b'\n')
 
     def memo_binget(self, index: int) -> None:
         if not isinstance(index, int):
             raise TypeError('memo index should be an integer')
         if not 0 <= index <= 2 ** 8 - 1:
             raise ValueError('memo index out of range for opcode BINGET')
-        self._payload += BINGET + p8(index)
+        self._write(_pack_opcode_u8(BINGET, index))
 
     def memo_long_binget(self, index: int) -> None:
         if not isinstance(index, int):
             raise TypeError('memo index should be an integer')
         if not 0 <= index <= 2 ** 32 - 1:
             raise ValueError('memo index out of range for opcode LONG_BINGET')
-        self._payload += LONG_BINGET + p32(index)
+        self._write(_pack_opcode_u32(LONG_BINGET, index))
 
     def memo_put(self, index: int) -> None:
         if not isinstance(index, int):
             raise TypeError('memo index should be an integer')
         if index < 0:
             raise ValueError('memo index should be non-negative')
-        self._payload += PUT + str(index).encode('ascii') + b'\n'
+        self._write(PUT + str(index).encode('ascii') + b'\n')
 
     def memo_binput(self, index: int) -> None:
         if not isinstance(index, int):
             raise TypeError('memo index should be an integer')
         if not 0 <= index <= 2 ** 8 - 1:
             raise ValueError('memo index out of range for opcode BINPUT')
-        self._payload += BINPUT + p8(index)
+        self._write(_pack_opcode_u8(BINPUT, index))
 
     def memo_long_binput(self, index: int) -> None:
         if not isinstance(index, int):
             raise TypeError('memo index should be an integer')
         if not 0 <= index <= 2 ** 32 - 1:
             raise ValueError('memo index out of range for opcode LONG_BINPUT')
-        self._payload += LONG_BINPUT + p32(index)
+        self._write(_pack_opcode_u32(LONG_BINPUT, index))
 
     def memo_memoize(self) -> None:
-        self._payload += MEMOIZE
+        self._write(MEMOIZE)
 
     def _util_push_bool(self, value: bool) -> None:
         if not isinstance(value, bool):
@@ -511,12 +1211,19 @@ class PickleAssembler:
     def _util_push_int(self, value: int) -> None:
         if not isinstance(value, int):
             raise TypeError('value should be an integer')
+        # The shortest encoding valid for the protocol is picked. Encoded sizes are: BININT1 2, BININT2 3, BININT 5,
+        # LONG1 2 + n and LONG4 5 + n (with n the number of bytes of the two's complement), and INT and LONG 2 + the
+        # number of characters of the decimal representation. On ties, the opcode picked first below is preferred.
         if self.proto == 0:
             self.push_int(value)
         elif 0 <= value <= 2 ** 8 - 1:
             self.push_binint1(value)
         elif 0 <= value <= 2 ** 16 - 1:
             self.push_binint2(value)
+        elif - 2 ** 15 <= value < 0 and self.proto >= 2:
+            self.push_long1(value)  # 3 or 4 bytes
+        elif - 9 <= value < 0:
+            self.push_int(value)  # 4 bytes, with protocol 1
         elif - 2 ** 31 <= value <= 2 ** 31 - 1:
             self.push_binint(value)
         elif self.proto == 1:
@@ -534,9 +1241,8 @@ class PickleAssembler:
         else:
             self.push_binfloat(value)
 
-    def _util_push_bytes(self, value: bytes) -> None:
-        if not isinstance(value, bytes):
-            raise TypeError('value should be bytes')
+    def _util_push_bytes(self, value: 'Buffer') -> None:
+        value = _as_bytes_like(value)
         if self.proto < 3:
             raise PickleProtocolMismatchError('must use at least protocol 3 to push bytes')
         length = len(value)
@@ -549,26 +1255,46 @@ class PickleAssembler:
         else:  # pragma: no cover
             self.push_binbytes8(value)
 
+    def _util_push_bytearray(self, value: bytearray) -> None:
+        if not isinstance(value, bytearray):
+            raise TypeError('value should be bytearray')
+        if self.proto < 5:
+            raise PickleProtocolMismatchError('must use at least protocol 5 to push bytearray')
+        self.push_bytearray8(value)
+
+    def _util_push_buffer(self, value: object) -> None:
+        if not isinstance(value, memoryview) and (_PickleBuffer is None or not isinstance(value, _PickleBuffer)):
+            raise TypeError('value should be a memoryview or PickleBuffer')
+        if self.proto < 5:
+            raise PickleProtocolMismatchError('must use at least protocol 5 to push out-of-band buffers')
+        with memoryview(value) as view:  # type: ignore[arg-type]
+            readonly = view.readonly
+        self.buffers.append(value)
+        self.push_next_buffer()
+        if readonly:
+            self.build_readonly_buffer()
+
     def _util_push_unicode(self, value: str) -> None:
         if not isinstance(value, str):
             raise TypeError('value should be str')
         if self.proto == 0:
             self.push_unicode(value)
         else:
-            length = len(value.encode('utf-8', 'surrogatepass'))
+            value_bytes = value.encode('utf-8', 'surrogatepass')
+            length = len(value_bytes)
             if self.proto < 4:
                 if length < 2 ** 32:  # pragma: no branch
-                    self.push_binunicode(value)
+                    self._push_binunicode_encoded(value_bytes)
                 else:  # pragma: no cover
                     self.push_unicode(value)
             elif length < 2 ** 8:
-                self.push_short_binunicode(value)
+                self._push_short_binunicode_encoded(value_bytes)
             elif length < 2 ** 32:  # pragma: no branch
-                self.push_binunicode(value)
+                self._push_binunicode_encoded(value_bytes)
             else:  # pragma: no cover
-                self.push_binunicode8(value)  # really large, rarely exceed this limit
+                self._push_binunicode8_encoded(value_bytes)  # really large, rarely exceed this limit
 
-    def _util_push_tuple(self, value: 'tuple[object, ...]') -> None:
+    def _util_push_tuple(self, value: 'tuple[object, ...]') -> '_UtilPushFrame':
         if not isinstance(value, tuple):
             raise TypeError('value should be tuple')
         if not value:
@@ -577,77 +1303,201 @@ class PickleAssembler:
                 self.build_tuple()
             else:
                 self.push_empty_tuple()
-        else:
-            short_flag = self.proto >= 2 and len(value) <= 3
-            if not short_flag:
-                self.push_mark()
-            for item in value:
-                self.util_push(item)
-            if short_flag:
-                getattr(self, 'build_tuple' + str(len(value)))()
-            else:
-                self.build_tuple()
+            return None
+        if self.proto >= 2 and len(value) <= 3:
+            return iter(value), getattr(self, 'build_tuple' + str(len(value)))
+        self.push_mark()
+        return iter(value), self.build_tuple
 
-    def _util_push_list(self, value: 'list[object]') -> None:
+    def _util_push_list(self, value: 'list[object]') -> '_UtilPushFrame':
         if not isinstance(value, list):
             raise TypeError('value should be list')
-        if not value:
-            if self.proto == 0:
-                self.push_mark()
-                self.build_list()
-            else:
-                self.push_empty_list()
-        else:
+        if value and self.batch_size is None and self.memoize is None:
+            self.push_mark()
+            return iter(value), self.build_list
+        if self.proto == 0:
             self.push_mark()
-            for item in value:
-                self.util_push(item)
             self.build_list()
+        else:
+            self.push_empty_list()
+        if not value:
+            return None
+        return self._util_push_batches(value, False, self.build_append, self.build_appends), _do_nothing
 
-    def _util_push_dict(self, value: 'dict[object, object]') -> None:
+    def _util_push_dict(self, value: 'dict[object, object]') -> '_UtilPushFrame':
         if not isinstance(value, dict):
             raise TypeError('value should be dict')
+        if value and self.batch_size is None and self.memoize is None:
+            self.push_mark()
+            return itertools.chain.from_iterable(value.items()), self.build_dict
+        if self.proto == 0:
+            self.push_mark()
+            self.build_dict()
+        else:
+            self.push_empty_dict()
         if not value:
-            if self.proto == 0:
+            return None
+        return self._util_push_batches(value.items(), True, self.build_setitem, self.build_setitems), _do_nothing
+
+    def _util_push_batches(self, items: 'Iterable[Any]', pairs: bool, build_one: 'Callable[[], None]',
+                           build_many: 'Callable[[], None]') -> 'Iterator[object]':
+        # Yields the objects for `util_push` to push, adding them to the container on the stack batch by batch.
+        # If `pairs` is true, items are (key, value) pairs of a dict, of which both the key and the value are yielded.
+        batch_size = self.batch_size if self.proto >= 1 else 1  # APPENDS and SETITEMS need protocol 1
+        iterator = iter(items)
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                return
+            if len(batch) > 1:
                 self.push_mark()
-                self.build_dict()
+            if pairs:
+                yield from itertools.chain.from_iterable(batch)
             else:
-                self.push_empty_dict()
-        else:
-            self.push_mark()
-            for k, v in value.items():
-                self.util_push(k)
-                self.util_push(v)
-            self.build_dict()
+                yield from batch
+            if len(batch) > 1:
+                build_many()
+            else:
+                build_one()
+
+    def _util_push_none(self, value: None) -> None:
+        if value is not None:
+            raise TypeError('value should be None')
+        self.push_none()
+
+    # Functions to push objects with `util_push`, keyed on the exact type of the object.
+    # Subclasses of these types are handled by the entry of the nearest base class in the MRO.
+    _util_push_dispatch = {
+        type(None): _util_push_none,
+        bool: _util_push_bool,
+        int: _util_push_int,
+        float: _util_push_float,
+        bytes: _util_push_bytes,
+        bytearray: _util_push_bytearray,
+        mmap.mmap: _util_push_bytes,
+        str: _util_push_unicode,
+        tuple: _util_push_tuple,
+        list: _util_push_list,
+        dict: _util_push_dict,
+        memoryview: _util_push_buffer,
+    }  # type: dict[type, Callable[[PickleAssembler, Any], _UtilPushFrame]]
+    if _PickleBuffer is not None:  # pragma: no branch
+        _util_push_dispatch[_PickleBuffer] = _util_push_buffer
+
+    @classmethod
+    def register_util_push_type(cls, value_type: type,
+                                handler: 'Callable[[PickleAssembler, Any], _UtilPushFrame]') -> None:
+        """Register a function to push objects of a certain type (and its subclasses) with `util_push`.
+
+        The registration applies to ``cls`` and its subclasses. ``handler(assembler, value)`` should push
+        ``value`` using the methods of ``assembler``, and return either None, or a tuple ``(items, build)``,
+        in which case ``items`` is an iterable of objects to be pushed with `util_push` next, and ``build`` is
+        called with no arguments after all of them have been pushed.
+
+        Args:
+            value_type: the type of objects to push with ``handler``
+            handler: the function to push objects of ``value_type``
+
+        """
+        if not isinstance(value_type, type):
+            raise TypeError('value type should be a type')
+        if not callable(handler):
+            raise TypeError('handler should be callable')
+        if '_util_push_dispatch' not in vars(cls):  # do not modify the dispatch table of base classes
+            cls._util_push_dispatch = dict(cls._util_push_dispatch)
+        cls._util_push_dispatch[value_type] = handler
+
+    def _util_push_find_handler(self, value_type: type) -> 'Callable[[PickleAssembler, Any], _UtilPushFrame]':
+        for base in value_type.__mro__[1:]:
+            if base in self._util_push_dispatch:
+                return self._util_push_dispatch[base]
+        raise TypeError('value of type {!r} is currently unsupported by `util_push`'.format(value_type.__name__))
 
     def util_push(self, value: object) -> None:
         """Higher-level utility function to push common objects (including nested objects).
 
         The object might be any nested structure involving the following types:
-            NoneType, bool, int, float, bytes, str, tuple, list, dict
+            NoneType, bool, int, float, bytes, bytearray, mmap.mmap, str, tuple, list, dict
+        and types registered with `register_util_push_type`. mmap.mmap objects are pushed as bytes, without copying
+        their contents until the payload is assembled.
+
+        memoryview and pickle.PickleBuffer objects are pushed out of band (protocol 5 or above): they are appended to
+        `buffers` without copying, which should be passed to the unpickler (as the ``buffers`` argument of
+        ``pickle.loads``) along with the payload.
 
-        Recursive objects are not supported.
+        Nested structures are traversed with an explicit stack instead of recursion, so there is no limit on
+        the nesting depth. If the assembler is created with ``memoize``, repeated objects are pushed from the memo,
+        and recursive objects are supported (lists and dicts are memoized before their items are pushed, so that
+        they can contain themselves); otherwise, recursive objects are not supported.
 
         """
-        if value is None:
-            self.push_none()
-        elif isinstance(value, bool):
-            self._util_push_bool(value)
-        elif isinstance(value, int):
-            self._util_push_int(value)
-        elif isinstance(value, float):
-            self._util_push_float(value)
-        elif isinstance(value, bytes):
-            self._util_push_bytes(value)
-        elif isinstance(value, str):
-            self._util_push_unicode(value)
-        elif isinstance(value, tuple):
-            self._util_push_tuple(value)
-        elif isinstance(value, list):
-            self._util_push_list(value)
-        elif isinstance(value, dict):
-            self._util_push_dict(value)
+        # `items` iterates over the items of the innermost container being pushed, and `build` builds the container
+        # once all items are pushed. The same pair for each enclosing container is saved on `stack`, along with
+        # the id of the container, which is kept in `active` while the container is being pushed.
+        items = iter((value,))  # type: Iterator[object]
+        build = _do_nothing  # type: Callable[[], None]
+        container_id = None  # type: Optional[int]
+        stack = []  # type: list[tuple[Iterator[object], Callable[[], None], Optional[int]]]
+        active = set()  # type: set[Optional[int]]
+        dispatch = self._util_push_dispatch
+        memo = self._util_memo
+        memo_by_value = _util_memo_value_types if self.memoize == 'equality' else ()
+        while True:
+            for value in items:
+                key = None  # type: Optional[Hashable]
+                if memo is not None and type(value) in _util_memo_types and value != ():  # () is shorter than a get
+                    key = (type(value), value) if type(value) in memo_by_value else id(value)
+                    if key in memo:
+                        self.memo_allocator.get(memo[key][0])
+                        continue
+                handler = dispatch.get(type(value))
+                if handler is None:
+                    handler = self._util_push_find_handler(type(value))
+                frame = handler(self, value)
+                if key is not None and (frame is None or type(value) is not tuple):
+                    self._util_memo_put(key, value)
+                if frame is not None:
+                    # With memoize, a tuple may be pushed again while pushing its own items (see
+                    # `_util_build_tuple_and_memo_put`); any other recursion would never end.
+                    if id(value) in active and (memo is None or type(value) is not tuple):
+                        raise ValueError('recursive objects are only supported by `util_push` '
+                                         'through lists and dicts with memoize')
+                    stack.append((items, build, container_id))
+                    items, build = iter(frame[0]), frame[1]
+                    container_id = id(value)
+                    active.add(container_id)
+                    if key is not None and type(value) is tuple:
+                        build = functools.partial(self._util_build_tuple_and_memo_put, build, key, value)
+                    break
+            else:
+                build()
+                active.discard(container_id)
+                if not stack:
+                    return
+                items, build, container_id = stack.pop()
+
+    def _util_memo_put(self, key: 'Hashable', value: object) -> None:
+        memo = cast('dict[Hashable, tuple[int, object]]', self._util_memo)
+        memo[key] = self.memo_allocator.put(), value
+
+    def _util_build_tuple_and_memo_put(self, build: 'Callable[[], None]', key: 'Hashable',
+                                       value: 'tuple[object, ...]') -> None:
+        memo = cast('dict[Hashable, tuple[int, object]]', self._util_memo)
+        if key not in memo:
+            build()
+            self._util_memo_put(key, value)
+            return
+        # The tuple is recursive and has already been pushed and memoized while pushing its items,
+        # so discard the items and get the tuple from the memo instead, like pickle._Pickler.save_tuple().
+        if self.proto >= 2 and len(value) <= 3:
+            for _ in value:
+                self.pop()
+        elif self.proto >= 1:
+            self.pop_mark()
         else:
-            raise TypeError('value of type {!r} is currently unsupported by `util_push`'.format(type(value).__name__))
+            for _ in range(len(value) + 1):  # items and the mark
+                self.pop()
+        self.memo_allocator.get(memo[key][0])
 
     def util_memo_get(self, index: int) -> None:
         if not isinstance(index, int):
@@ -678,12 +1528,1036 @@ class PickleAssembler:
             self.memo_put(index)
 
 
+class MemoAllocator:
+    """Allocator of memo indices for a pickle assembler.
+
+    Memo entries are referred to by handles instead of indices. The indices are picked when the payload is assembled,
+    so that the entries fetched most often get indices with the shortest encoding. With protocol 4 or above,
+    ``MEMOIZE`` is used to store entries whose index equals the size of the memo at that point.
+
+    The allocator assumes that the memo is not used otherwise. When the assembler writes to a sink, splits its
+    payload into frames or edits a loaded payload, indices are picked right away in the order that entries are
+    stored. Memo opcodes recorded in `PickleAssembler.ir` are placeholders until the instructions are read, lowered
+    or optimized.
+
+    """
+
+    def __init__(self, assembler: PickleAssembler) -> None:
+        """Create a new memo allocator.
+
+        Args:
+            assembler: the pickle assembler to generate memo opcodes for
+
+        """
+        # A proxy avoids a reference cycle, so that the assembler (and the buffers it references) is freed as soon as
+        # it is no longer used.
+        self._assembler = weakref.proxy(assembler)  # type: PickleAssembler
+        # The protocol is kept, so that the placeholders recorded in `PickleIR` can be filled in without the assembler.
+        self._proto = assembler.proto  # type: Final[int]
+        self._indices = []  # type: list[Optional[int]]  # memo index of each handle, None if not picked yet
+        self._get_counts = []  # type: list[int]  # number of gets of each handle whose index is not picked yet
+        # The payload position (index of the segment and offset in it), handle and kind (get or put) of each memo
+        # opcode whose index is not picked yet.
+        self._pending = []  # type: list[tuple[tuple[int, int], int, bool]]
+        # The same for placeholders recorded in `PickleAssembler.ir`, with the index of the instruction as position.
+        self._pending_ir = []  # type: list[tuple[int, int, bool]]
+        self._removed = set()  # type: set[int]  # handles of entries removed by `PickleAssembler.optimize`
+        # Indices of the entries stored by a payload loaded by `PickleAssembler.from_bytes`, and the index given to
+        # the first handle, after them.
+        self._loaded_indices = set()  # type: set[int]
+        self._first_index = 0
+
+    def __getstate__(self) -> 'dict[str, object]':
+        # The reference to the assembler is restored by `PickleAssembler.__setstate__`.
+        state = dict(self.__dict__)
+        del state['_assembler']
+        return state
+
+    @property
+    def pending(self) -> bool:
+        """Whether there are memo opcodes whose indices are not picked yet."""
+        return bool(self._pending or self._pending_ir)
+
+    def put(self) -> int:
+        """Store the top of the stack in a new memo entry.
+
+        Returns:
+            the handle of the new memo entry
+
+        """
+        handle = len(self._indices)
+        assembler = self._assembler
+        # Opcodes in a sink or in frames cannot be changed later, so the index is picked right away, unless the opcodes
+        # are recorded in `ir` and only encoded afterwards.
+        immediate = assembler._loaded is not None or (  # pylint: disable=protected-access
+            not assembler._recording  # pylint: disable=protected-access
+            and (assembler._sink is not None or assembler.frame_size is not None))  # pylint: disable=protected-access
+        self._indices.append(self._first_index + handle if immediate else None)
+        self._get_counts.append(0)
+        self._emit(handle, False)
+        return handle
+
+    def get(self, handle: int) -> None:
+        """Push an item from the memo.
+
+        Args:
+            handle: the handle of the memo entry, as returned by `put`
+
+        """
+        if not isinstance(handle, int):
+            raise TypeError('memo handle should be an integer')
+        if not 0 <= handle < len(self._indices):
+            raise ValueError('unknown memo handle')
+        if handle in self._removed:
+            raise ValueError('memo entry has been removed by optimize()')
+        if self._indices[handle] is None:
+            self._get_counts[handle] += 1
+        self._emit(handle, True)
+
+    def resolve(self, segments: 'list[Buffer]') -> None:
+        """Pick the indices of memo entries, and fill in the pending memo opcodes.
+
+        Args:
+            segments: the segments of the payload generated so far; those with pending memo opcodes are replaced with
+                new ones with the opcodes filled in (placeholders in `PickleAssembler.ir` are filled in as well)
+
+        """
+        self._pick_indices()
+        if self._pending_ir:
+            self._fill_ir(cast(PickleIR, self._assembler.ir)._encodings)  # pylint: disable=protected-access
+        for index, fixups in itertools.groupby(self._pending, key=lambda fixup: fixup[0][0]):
+            result = bytearray()
+            position = 0
+            with memoryview(segments[index]) as view:
+                for (_, offset), handle, is_get in fixups:
+                    result += view[position:offset]
+                    result += self._encode(handle, is_get)
+                    position = offset
+                result += view[position:]
+            segments[index] = result
+        self._pending = []
+
+    def _emit(self, handle: int, is_get: bool) -> None:
+        assembler = self._assembler
+        model = assembler._stack_model  # pylint: disable=protected-access
+        if model is not None:  # only the stack effect is checked, as the index is not known before assembly
+            if is_get:
+                model.apply(1)
+            else:
+                model.check_pops(1, MEMOIZE[0] if assembler.proto >= 4 else PUT[0])
+        if self._indices[handle] is None:
+            if assembler._recording:  # pylint: disable=protected-access
+                assembler._write(_MEMO_PLACEHOLDER)  # pylint: disable=protected-access
+                self._pending_ir.append((len(cast(PickleIR, assembler.ir)) - 1, handle, is_get))
+            else:
+                position = assembler._payload_position()  # pylint: disable=protected-access
+                self._pending.append((position, handle, is_get))
+        else:
+            assembler._write(self._encode(handle, is_get))  # pylint: disable=protected-access
+
+    def _encode(self, handle: int, is_get: bool) -> bytes:
+        index = cast(int, self._indices[handle])
+        if is_get:
+            return _encode_memo_get(self._proto, index)
+        return _encode_memo_put(self._proto, index, self._memo_size(handle))
+
+    def _fill_ir(self, encodings: 'list[_Encoding]') -> None:
+        # Pick the indices of memo entries, and fill in the placeholders recorded in the encodings of `PickleIR`.
+        self._pick_indices()
+        for index, handle, is_get in self._pending_ir:
+            encodings[index] = self._encode(handle, is_get)
+        self._pending_ir = []
+
+    def _memo_size(self, handle: int) -> int:
+        # The number of memo entries when the entry of the given handle is stored.
+        return len(self._loaded_indices) + handle - len(self._removed)
+
+    def _load_indices(self, indices: 'set[int]') -> None:
+        # Take into account the entries stored by a loaded payload, before any handle is created.
+        self._loaded_indices = indices
+        self._first_index = max(indices) + 1 if indices else 0
+
+    def _remove_indices(self, indices: 'set[int]') -> 'set[int]':
+        # Forget the entries with the given indices, which have been removed from the payload, returning their handles.
+        handles = {handle for handle, index in enumerate(self._indices) if index in indices}
+        self._removed |= handles
+        self._loaded_indices -= indices
+        return handles
+
+    def _pick_indices(self) -> None:
+        # Handles are given indices in the order of their creation, unless it is shorter overall to give
+        # the smallest indices to the handles fetched most often.
+        proto = self._proto
+        first = next((handle for handle, index in enumerate(self._indices) if index is None), len(self._indices))
+        handles = range(first, len(self._indices))
+        indices = range(self._first_index + first, self._first_index + len(self._indices))
+        by_gets = sorted(handles, key=lambda handle: -self._get_counts[handle])
+
+        def cost(order: 'Iterable[int]') -> int:
+            return sum(len(_encode_memo_put(proto, index, self._memo_size(handle)))
+                       + self._get_counts[handle] * len(_encode_memo_get(proto, index))
+                       for index, handle in zip(indices, order))
+
+        order = by_gets if cost(by_gets) < cost(handles) else handles
+        for index, handle in zip(indices, order):
+            self._indices[handle] = index
+
+
 class PickleProtocolMismatchError(Exception):
     """Raised when opcode does not match protocol."""
 
 
+class PickleValidationError(Exception):
+    """Raised when opcodes misuse the unpickler stack, its marks or its memo."""
+
+
+class Instruction:
+    """A pickle instruction, as returned by `disassemble` or recorded in `PickleIR`.
+
+    Attributes:
+        opcode: the opcode of the instruction, one of the `Opcode` constants (None for raw data in `PickleIR`)
+        arg: the argument of the instruction, or None if the opcode takes no argument; arguments of string and
+            bytes opcodes (and of ``PERSID``) are memoryviews of the argument as encoded in the pickle, arguments of
+            ``GLOBAL`` and ``INST`` are (module, name) tuples, and other arguments are numbers
+        pos: the position of the instruction in the pickle
+
+    """
+    __slots__ = ('opcode', 'arg', 'pos')
+
+    def __init__(self, opcode: 'Optional[Opcode]', arg: object, pos: int) -> None:
+        self.opcode = opcode  # type: Optional[Opcode]
+        self.arg = arg  # type: object
+        self.pos = pos  # type: int
+
+    def __repr__(self) -> str:
+        return 'Instruction({}, {!r}, {})'.format(None if self.opcode is None else self.opcode.name, self.arg, self.pos)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Instruction):
+            return NotImplemented
+        return self.opcode is other.opcode and self.arg == other.arg and self.pos == other.pos
+
+
+class PickleIR:
+    """Instructions recorded by a pickle assembler created with ``ir=True``, before they are encoded.
+
+    Instructions are recorded as a table of their encodings, and their opcodes are kept in `codes`, which can be
+    scanned quickly. Indexing or iteration gives `Instruction` objects whose ``pos`` is the index of the instruction.
+    Data added with `PickleAssembler.append_raw` is an instruction of its own, with None as opcode and the data as
+    argument. The protocol header is not recorded.
+
+    """
+
+    def __init__(self) -> None:
+        """Create an empty instruction list."""
+        # The encoding of each instruction, including the opcode; for opcodes whose argument is written separately,
+        # a tuple of the opcode (with the size of the argument) and the pieces of the argument. Recording is a
+        # single list append per opcode, while the codes are only filled in when needed.
+        self._encodings = []  # type: list[_Encoding]
+        self._codes = array.array('B')  # type: array.array[int]
+        # The allocator of the assembler recording the instructions, which fills in the memo opcodes recorded as
+        # placeholders before the instructions are read.
+        self._memo_allocator = None  # type: Optional[MemoAllocator]
+
+    @property
+    def codes(self) -> 'array.array[int]':
+        """The opcode byte of each instruction, or `_RAW_CODE` (0) for raw data (not to be modified)."""
+        self._fill_memo()
+        codes = self._codes
+        if len(codes) < len(self._encodings):
+            codes.extend(map(_encoding_code, itertools.islice(self._encodings, len(codes), None)))
+        return codes
+
+    def __copy__(self) -> 'PickleIR':
+        self._fill_memo()
+        return self._copy()
+
+    def __getstate__(self) -> 'dict[str, object]':
+        self._fill_memo()
+        state = dict(self.__dict__)
+        state['_memo_allocator'] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self._encodings)
+
+    def __getitem__(self, index: int) -> Instruction:
+        if not isinstance(index, int):
+            raise TypeError('instruction index should be an integer')
+        code = self.codes[index]
+        if index < 0:
+            index += len(self.codes)
+        encoding = self._encodings[index]
+        if isinstance(encoding, tuple):
+            return Instruction(_disassemble_table[code][0], memoryview(encoding[1]), index)
+        if code == _RAW_CODE:
+            return Instruction(None, bytes(encoding), index)
+        data = encoding + STOP
+        instruction = _disassemble(memoryview(data), data)[0]
+        instruction.pos = index
+        return instruction
+
+    def __iter__(self) -> 'Iterator[Instruction]':
+        return map(self.__getitem__, range(len(self.codes)))
+
+    def _copy(self) -> 'PickleIR':
+        # A copy of the instructions, placeholders included, not bound to any allocator.
+        other = PickleIR()
+        other._encodings = list(self._encodings)  # the encodings themselves are not modified
+        other._codes = array.array('B', self._codes)
+        return other
+
+    def _fill_memo(self) -> None:
+        # Fill in the memo opcodes recorded as placeholders, if any.
+        allocator = self._memo_allocator
+        if allocator is not None and allocator._pending_ir:  # pylint: disable=protected-access
+            allocator._fill_ir(self._encodings)  # pylint: disable=protected-access
+
+
+def disassemble(data: 'Buffer') -> 'list[Instruction]':
+    """Disassemble a pickle into a list of instructions.
+
+    Disassembling stops after the ``STOP`` opcode. Arguments of string and bytes opcodes are memoryviews of ``data``
+    rather than copies, so ``data`` should not be modified while they are in use.
+
+    The garbage collector is paused while the instructions are created, and enabled again afterwards if it was
+    enabled before. The instructions cannot form reference cycles, and otherwise collections triggered over and over
+    by the new objects take most of the time on large pickles. Other threads are affected by the pause as well.
+
+    Args:
+        data: the pickle to disassemble
+
+    Returns:
+        the instructions of the pickle, ending with ``STOP``
+
+    """
+    view = memoryview(_as_bytes_like(data))
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _disassemble(view, data if isinstance(data, (bytes, bytearray)) else None)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _disassemble(view: memoryview, text: 'Optional[bytes | bytearray]') -> 'list[Instruction]':
+    # Disassemble a pickle given as a memoryview, and as bytes if available (for line arguments), for `disassemble`.
+    scanned = view if text is None else text  # indexing bytes is faster than indexing a memoryview
+    instructions = []  # type: list[Instruction]
+    append = instructions.append
+    table = _disassemble_table
+    structs = _arg_structs
+    stop_code = STOP[0]
+    size = len(view)
+    pos = 0
+    while pos < size:
+        start = pos
+        code = scanned[pos]
+        try:
+            opcode, kind = table[code]
+        except KeyError:
+            raise ValueError('unknown opcode {!r} at position {}'.format(view[pos:pos + 1].tobytes(), pos)) from None
+        pos += 1
+        if kind == _ARG_NONE:
+            append(Instruction(opcode, None, start))
+            if code == stop_code:
+                return instructions
+            continue
+        if kind <= _ARG_LONG:  # a number, possibly the size of the argument
+            unpack_from, width = structs[code]
+            if pos + width > size:
+                raise ValueError('truncated argument of opcode {} at position {}'.format(opcode.name, start))
+            arg = unpack_from(scanned, pos)[0]  # type: object
+            pos += width
+            if kind != _ARG_FIXED:
+                end = pos + cast(int, arg)
+                if end > size or end < pos:
+                    raise ValueError('invalid argument size of opcode {} at position {}'.format(opcode.name, start))
+                arg = view[pos:end] if kind == _ARG_COUNTED else int.from_bytes(view[pos:end], 'little', signed=True)
+                pos = end
+        else:
+            if text is None:
+                text = view.tobytes()
+            end = text.find(b'\n', pos)
+            if kind == _ARG_NAMES and end >= 0:
+                module = text[pos:end]
+                pos = end + 1
+                end = text.find(b'\n', pos)
+            if end < 0:
+                raise ValueError('unterminated argument of opcode {} at position {}'.format(opcode.name, start))
+            if kind == _ARG_LINE:
+                arg = _line_parsers[code](text[pos:end])
+            elif kind == _ARG_TEXT:
+                arg = view[pos:end]
+            else:
+                arg = module.decode('utf-8'), text[pos:end].decode('utf-8')
+            pos = end + 1
+        append(Instruction(opcode, arg, start))
+    raise ValueError('pickle exhausted before seeing STOP')
+
+
+def _split_opcodes(data: bytes, pos: int) -> 'tuple[bytearray, list[_Encoding]]':
+    # Split a pickle into the codes and encodings of its opcodes from position ``pos`` up to STOP, leaving out frames
+    # and STOP itself. The arguments of counted and text opcodes are views of the pickle, so that large arguments are
+    # not copied.
+    table = _disassemble_table
+    structs = _arg_structs
+    sizes = _fixed_sizes
+    view = memoryview(data)
+    frame_code = FRAME[0]
+    stop_code = STOP[0]
+    codes = bytearray()
+    encodings = []  # type: list[_Encoding]
+    append = encodings.append
+    size = len(data)
+    while pos < size:
+        start = pos
+        code = data[pos]
+        step = sizes[code]
+        if step:  # most opcodes
+            pos += step
+            if pos > size:
+                raise ValueError('truncated argument of opcode {} at position {}'.format(table[code][0].name, start))
+            if code == stop_code:
+                return codes, encodings
+            if code != frame_code:
+                append(data[start:pos])
+                codes.append(code)
+            continue
+        try:
+            opcode, kind = table[code]
+        except KeyError:
+            raise ValueError('unknown opcode {!r} at position {}'.format(data[pos:pos + 1], pos)) from None
+        pos += 1
+        if kind <= _ARG_LONG:  # the size of the argument
+            unpack_from, width = structs[code]
+            end = pos + width
+            if end > size:
+                raise ValueError('truncated argument of opcode {} at position {}'.format(opcode.name, start))
+            end += unpack_from(data, pos)[0]
+            pos += width
+            if end > size or end < pos:
+                raise ValueError('invalid argument size of opcode {} at position {}'.format(opcode.name, start))
+        else:
+            end = data.find(b'\n', pos)
+            if kind == _ARG_NAMES and end >= 0:
+                end = data.find(b'\n', end + 1)
+            if end < 0:
+                raise ValueError('unterminated argument of opcode {} at position {}'.format(opcode.name, start))
+            end += 1
+        if kind == _ARG_COUNTED or kind == _ARG_TEXT:
+            append((data[start:pos], view[pos:end]))
+        else:
+            append(data[start:end])
+        codes.append(code)
+        pos = end
+    raise ValueError('pickle exhausted before seeing STOP')
+
+
+def optimize_memo(data: 'Buffer') -> bytes:
+    """Remove the memo entries of a pickle which are never fetched, and renumber the others.
+
+    This is a faster equivalent of `pickletools.optimize`: only memo opcodes are decoded, and the rest of the pickle
+    is copied as is. Remaining entries are renumbered in the order they are stored, so that memo opcodes get the
+    shortest encodings for the protocol of the pickle (``MEMOIZE`` with protocol 4 or above). The protocol is taken
+    from the ``PROTO`` opcode, or else is 1 if the pickle has binary memo opcodes and 0 otherwise. Frames are kept,
+    with their sizes adjusted (frames left empty are removed).
+
+    Args:
+        data: the pickle to optimize
+
+    Returns:
+        the optimized pickle
+
+    """
+    view = memoryview(_as_bytes_like(data))
+    text = data if isinstance(data, bytes) else view.tobytes()  # bytes are indexed faster than memoryviews
+    found = _scan_memo_opcodes(text)
+    if text[:1] == PROTO:
+        proto = text[1]
+    else:
+        proto = int(any(code in _binary_memo_codes for _, _, code, _ in found))
+    get_codes = {GET[0], BINGET[0], LONG_BINGET[0]}
+    memoize_code = MEMOIZE[0]
+    frame_code = FRAME[0]
+    stop_code = STOP[0]
+    fetched = {arg for _, _, code, arg in found if code in get_codes}
+    stored = set()  # type: set[int]  # indices of entries stored so far, whose number is the index used by MEMOIZE
+    new_indices = {}  # type: dict[int, int]  # new index of each entry which is kept, keyed on its index
+    kept = 0  # the number of entries kept so far
+    result = bytearray()
+    position = 0  # the position in `data` up to which the pickle has been copied to `result`
+    frame_header = None  # type: Optional[int]  # the position of the header of the open frame in `result`
+    frame_end = 0  # the position in `data` where the open frame ends
+
+    def close_frame() -> None:
+        nonlocal position, frame_header
+        header = cast(int, frame_header)
+        result.extend(view[position:frame_end])
+        position = frame_end
+        frame_size = len(result) - header - 9
+        if frame_size:
+            result[header:header + 9] = _pack_opcode_u64(FRAME, frame_size)
+        else:
+            del result[header:]
+        frame_header = None
+
+    for start, end, code, arg in found:
+        if frame_header is not None and start >= frame_end:
+            close_frame()
+        if code == stop_code:
+            break
+        result += view[position:start]
+        position = end
+        if code == frame_code:
+            frame_header = len(result)
+            result += _FRAME_HEADER_PLACEHOLDER
+            frame_end = end + arg
+        elif code in get_codes:
+            try:
+                result += _encode_memo_get(proto, new_indices[arg])
+            except KeyError:
+                raise ValueError('memo entry {} is fetched before being stored, at position {}'.format(
+                    arg, start)) from None
+        else:
+            index = len(stored) if code == memoize_code else arg
+            stored.add(index)
+            if index in fetched:
+                new_indices[index] = kept
+                result += _encode_memo_put(proto, kept, kept)
+                kept += 1
+    if frame_header is not None:
+        close_frame()
+    result += view[position:found[-1][1]]
+    return bytes(result)
+
+
+def simulate(data: 'Buffer') -> int:
+    """Check the stack effects of the opcodes of a pickle without unpickling it.
+
+    The opcodes are run on a model of the unpickler stack, its marks and its memo in a single pass. Only the shape of
+    the stack is checked, not the types of the objects on it.
+
+    Args:
+        data: the pickle to check
+
+    Returns:
+        the maximum number of items on the stack while unpickling (not counting marks)
+
+    Raises:
+        PickleValidationError: if an opcode pops more items than there are above the topmost mark, if no mark is
+            found for an opcode which pops one, or if a memo entry is fetched before being stored
+
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return _simulate(data)
+    return _simulate(memoryview(_as_bytes_like(data)).tobytes())
+
+
 # Internal operations.
 
+def _do_nothing() -> None:
+    pass
+
+
+def _as_bytes_like(value: 'Buffer') -> 'bytes | memoryview':
+    # Get the contents of a buffer as a bytes-like object whose length is its size in bytes, without copying it
+    # (unless the buffer is not contiguous).
+    if type(value) is bytes:
+        return value
+    try:
+        view = memoryview(value)
+    except TypeError:
+        raise TypeError('value should be a bytes-like object') from None
+    if not view.c_contiguous:
+        return view.tobytes()
+    if view.ndim != 1 or view.itemsize != 1:
+        return view.cast('B')
+    return view
+
+
+def _parse_int_line(line: 'bytes | bytearray') -> int:
+    if line == b'00':
+        return False
+    if line == b'01':
+        return True
+    return int(line)
+
+
+def _parse_long_line(line: 'bytes | bytearray') -> int:
+    return int(line[:-1] if line.endswith(b'L') else line)  # the suffix is written by Python 2
+
+
+# Kinds of opcode arguments for `disassemble`: none, a fixed-size number, a counted string, a counted integer,
+# a number on a line, a string on a line, and two names on separate lines. The order is relied on.
+_ARG_NONE, _ARG_FIXED, _ARG_COUNTED, _ARG_LONG, _ARG_LINE, _ARG_TEXT, _ARG_NAMES = range(7)
+
+
+def _arg_struct(fmt: str) -> 'tuple[Callable[[Buffer, int], tuple[Any, ...]], int]':
+    packer = struct.Struct(fmt)
+    return packer.unpack_from, packer.size
+
+
+# The kind of the argument of each opcode taking one, with the struct format of the number for the first kinds.
+_arg_formats = {
+    INT: (_ARG_LINE, None),
+    LONG: (_ARG_LINE, None),
+    FLOAT: (_ARG_LINE, None),
+    GET: (_ARG_LINE, None),
+    PUT: (_ARG_LINE, None),
+    STRING: (_ARG_TEXT, None),
+    UNICODE: (_ARG_TEXT, None),
+    PERSID: (_ARG_TEXT, None),
+    GLOBAL: (_ARG_NAMES, None),
+    INST: (_ARG_NAMES, None),
+    BININT: (_ARG_FIXED, '<i'),
+    BININT1: (_ARG_FIXED, '<B'),
+    BININT2: (_ARG_FIXED, '<H'),
+    BINFLOAT: (_ARG_FIXED, '>d'),
+    BINGET: (_ARG_FIXED, '<B'),
+    LONG_BINGET: (_ARG_FIXED, '<I'),
+    BINPUT: (_ARG_FIXED, '<B'),
+    LONG_BINPUT: (_ARG_FIXED, '<I'),
+    PROTO: (_ARG_FIXED, '<B'),
+    EXT1: (_ARG_FIXED, '<B'),
+    EXT2: (_ARG_FIXED, '<H'),
+    EXT4: (_ARG_FIXED, '<i'),
+    FRAME: (_ARG_FIXED, '<Q'),
+    SHORT_BINSTRING: (_ARG_COUNTED, '<B'),
+    BINSTRING: (_ARG_COUNTED, '<i'),
+    SHORT_BINBYTES: (_ARG_COUNTED, '<B'),
+    BINBYTES: (_ARG_COUNTED, '<I'),
+    BINBYTES8: (_ARG_COUNTED, '<Q'),
+    BYTEARRAY8: (_ARG_COUNTED, '<Q'),
+    SHORT_BINUNICODE: (_ARG_COUNTED, '<B'),
+    BINUNICODE: (_ARG_COUNTED, '<I'),
+    BINUNICODE8: (_ARG_COUNTED, '<Q'),
+    LONG1: (_ARG_LONG, '<B'),
+    LONG4: (_ARG_LONG, '<i'),
+}  # type: Final[dict[Opcode, tuple[int, Optional[str]]]]
+
+# Opcodes keyed on their code, with the kind of their argument.
+_disassemble_table = {
+    opcode[0]: (opcode, _arg_formats.get(opcode, (_ARG_NONE, None))[0])
+    for opcode in globals().values() if isinstance(opcode, Opcode)
+}  # type: Final[dict[int, tuple[Opcode, int]]]
+
+# How to read the number of opcodes whose argument is (or starts with) one, keyed on their code.
+_arg_structs = {
+    opcode[0]: _arg_struct(fmt) for opcode, (_, fmt) in _arg_formats.items() if fmt is not None
+}  # type: Final[dict[int, tuple[Callable[[Buffer, int], tuple[Any, ...]], int]]]
+
+# How to parse the argument of opcodes whose argument is a number on a line, keyed on their code.
+_line_parsers = {
+    INT[0]: _parse_int_line,
+    LONG[0]: _parse_long_line,
+    FLOAT[0]: float,
+    GET[0]: int,
+    PUT[0]: int,
+}  # type: Final[dict[int, Callable[[bytes | bytearray], object]]]
+
+_RAW_CODE = 0  # type: Final[int]  # code of raw data in `PickleIR`, which is not an opcode
+
+
+class _RawData(bytes):  # raw data recorded in `PickleIR`
+    pass
+
+
+# Recorded in `PickleIR` for a memo opcode of `MemoAllocator` whose index is not picked yet.
+_MEMO_PLACEHOLDER = b''  # type: Final[bytes]
+
+
+def _encoding_code(encoding: '_Encoding') -> int:
+    # The code of an instruction in `PickleIR` given its encoding.
+    if isinstance(encoding, tuple):
+        return encoding[0][0]
+    if isinstance(encoding, _RawData):
+        return _RAW_CODE
+    return encoding[0]
+
+
+# Sizes of opcodes keyed on their code, for those whose size is fixed (0 for the others).
+_fixed_sizes = [0] * 256  # type: Final[list[int]]
+for _code, (_opcode, _kind) in _disassemble_table.items():
+    if _kind == _ARG_NONE:
+        _fixed_sizes[_code] = 1
+    elif _kind == _ARG_FIXED:
+        _fixed_sizes[_code] = 1 + _arg_structs[_code][1]
+
+del _code, _opcode, _kind  # pylint: disable=undefined-loop-variable
+
+_memo_codes = frozenset(map(ord, [
+    GET, BINGET, LONG_BINGET, PUT, BINPUT, LONG_BINPUT, MEMOIZE,
+]))  # type: Final[frozenset[int]]
+
+# The same as `_fixed_sizes`, but without the opcodes which are not skipped by `_scan_memo_opcodes`.
+_skipped_sizes = [0 if code in _memo_codes or code in (FRAME[0], STOP[0]) else size
+                  for code, size in enumerate(_fixed_sizes)]  # type: Final[list[int]]
+
+_binary_memo_codes = frozenset(map(ord, [BINGET, LONG_BINGET, BINPUT, LONG_BINPUT]))  # type: Final[frozenset[int]]
+
+
+def _scan_memo_opcodes(data: bytes) -> 'list[tuple[int, int, int, int]]':
+    # Find the memo opcodes and frames of a pickle, and its STOP opcode, as their start and end positions, code and
+    # argument (0 if none). Other opcodes are skipped without being decoded.
+    sizes = _skipped_sizes
+    table = _disassemble_table
+    found = []  # type: list[tuple[int, int, int, int]]
+    append = found.append
+    size = len(data)
+    pos = 0
+    while pos < size:
+        code = data[pos]
+        step = sizes[code]
+        if step:
+            pos += step
+            continue
+        start = pos
+        try:
+            opcode, kind = table[code]
+        except KeyError:
+            raise ValueError('unknown opcode {!r} at position {}'.format(data[pos:pos + 1], pos)) from None
+        pos += 1
+        if kind == _ARG_NONE:  # MEMOIZE or STOP
+            append((start, pos, code, 0))
+            if opcode is STOP:
+                return found
+        elif kind <= _ARG_LONG:
+            unpack_from, width = _arg_structs[code]
+            if pos + width > size:
+                raise ValueError('truncated argument of opcode {} at position {}'.format(opcode.name, start))
+            arg = unpack_from(data, pos)[0]
+            pos += width
+            if kind == _ARG_FIXED:  # a memo opcode or FRAME
+                append((start, pos, code, arg))
+            elif arg < 0 or pos + arg > size:
+                raise ValueError('invalid argument size of opcode {} at position {}'.format(opcode.name, start))
+            else:
+                pos += arg
+        else:
+            end = data.find(b'\n', pos)
+            if kind == _ARG_NAMES and end >= 0:
+                end = data.find(b'\n', end + 1)
+            if end < 0:
+                raise ValueError('unterminated argument of opcode {} at position {}'.format(opcode.name, start))
+            if opcode is GET or opcode is PUT:
+                append((start, end + 1, code, int(data[pos:end])))
+            pos = end + 1
+    raise ValueError('pickle exhausted before seeing STOP')
+
+
+# Stack effects of opcodes keyed on their code, as the number of items they pop and push. Opcodes which pop the items
+# above the topmost mark and the mark itself are listed in `_mark_pops` instead, with the number of items they push
+# afterwards. ``POP`` pops the topmost mark if there is no item above it.
+_stack_effects = dict.fromkeys(map(ord, [
+    NONE, NEWTRUE, NEWFALSE, INT, BININT, BININT1, BININT2, LONG, LONG1, LONG4, FLOAT, BINFLOAT, STRING, BINSTRING,
+    SHORT_BINSTRING, BINBYTES, BINBYTES8, SHORT_BINBYTES, BYTEARRAY8, UNICODE, BINUNICODE, BINUNICODE8,
+    SHORT_BINUNICODE, EMPTY_TUPLE, EMPTY_LIST, EMPTY_DICT, EMPTY_SET, GLOBAL, GET, BINGET, LONG_BINGET, PERSID, EXT1,
+    EXT2, EXT4, NEXT_BUFFER,
+]), (0, 1))  # type: Final[dict[int, tuple[int, int]]]
+_stack_effects.update(dict.fromkeys(map(ord, [PUT, BINPUT, LONG_BINPUT, MEMOIZE, PROTO, FRAME]), (0, 0)))
+_stack_effects.update(dict.fromkeys(map(ord, [BINPERSID, TUPLE1, READONLY_BUFFER]), (1, 1)))
+_stack_effects.update(dict.fromkeys(map(ord, [TUPLE2, APPEND, REDUCE, BUILD, NEWOBJ, STACK_GLOBAL]), (2, 1)))
+_stack_effects.update(dict.fromkeys(map(ord, [TUPLE3, SETITEM, NEWOBJ_EX]), (3, 1)))
+_stack_effects.update({POP[0]: (1, 0), DUP[0]: (1, 2), STOP[0]: (1, 0)})
+
+_mark_pops = dict.fromkeys(map(ord, [TUPLE, LIST, DICT, FROZENSET, INST, OBJ]), 1)  # type: Final[dict[int, int]]
+_mark_pops.update(dict.fromkeys(map(ord, [APPENDS, SETITEMS, ADDITEMS, POP_MARK]), 0))
+
+_UNKNOWN_DEPTH = 1 << 62  # type: Final[int]  # the number of items above the topmost mark when it cannot be tracked
+
+
+def _encodings_size(encodings: 'Iterable[_Encoding]') -> int:
+    # The total size of instructions given by their encodings, as recorded in `PickleIR`.
+    return sum(sum(map(len, encoding)) if isinstance(encoding, tuple) else len(encoding) for encoding in encodings)
+
+
+def _memo_index(code: int, data: 'bytes | bytearray', arg_start: int, end: int) -> int:
+    # The memo index of a memo opcode other than MEMOIZE, given the positions of its argument and its end.
+    if code == BINGET[0] or code == BINPUT[0]:
+        return data[arg_start]
+    if code == LONG_BINGET[0] or code == LONG_BINPUT[0]:
+        return int.from_bytes(data[arg_start:end], 'little')
+    return int(data[arg_start:end - 1])
+
+
+def _optimize_instructions(codes: 'array.array[int] | bytes | bytearray', encodings: 'list[_Encoding]',
+                           proto: int) -> 'tuple[list[_Encoding], set[int]]':
+    # Peephole pass of `PickleAssembler.optimize` over instructions given by their codes and encodings (as recorded
+    # in `PickleIR`), in a single scan keeping track of the number of items above each mark. Returns the encodings of
+    # the optimized instructions and the memo indices whose entries are removed.
+    get_codes = {GET[0], BINGET[0], LONG_BINGET[0]}
+    put_codes = {PUT[0], BINPUT[0], LONG_BINPUT[0]}
+    code_bytes = bytes(codes)
+    if code_bytes.find(_RAW_CODE) >= 0:
+        # Raw data might fetch any memo entry.
+        fetched = None  # type: Optional[set[int]]
+        first_removable = len(codes)
+    else:
+        fetched = {_memo_index(code, cast(bytes, encodings[index]), 1, len(encodings[index]))
+                   for index, code in enumerate(codes) if code in get_codes}
+        # Removing a memo entry changes the index used by MEMOIZE afterwards.
+        first_removable = code_bytes.rfind(MEMOIZE) + 1
+    effects = _stack_effects
+    mark_pops = _mark_pops
+    # The opcodes replacing TUPLE, keyed on the number of items above the mark.
+    short_tuples = {}  # type: dict[int, Opcode]
+    if proto >= 1:
+        short_tuples[0] = EMPTY_TUPLE
+    if proto >= 2:
+        short_tuples.update({1: TUPLE1, 2: TUPLE2, 3: TUPLE3})
+    result = []  # type: list[Optional[_Encoding]]  # None for removed marks
+    result_codes = bytearray()
+    removed = set()  # type: set[int]
+    marks = []  # type: list[tuple[int, int]]  # the depth below each mark, and its position in `result`
+    depth = 0  # the number of items above the topmost mark
+    mark_code = MARK[0]
+    tuple_code = TUPLE[0]
+    pop_code = POP[0]
+    dup_code = DUP[0]
+    for index, code in enumerate(codes):
+        encoding = encodings[index]
+        if code == mark_code:
+            marks.append((depth, len(result)))
+            depth = 0
+        elif code in mark_pops:
+            if marks:
+                below, position = marks.pop()
+                if code == tuple_code and depth in short_tuples:
+                    result[position] = None
+                    result_codes[position] = _RAW_CODE
+                    encoding = short_tuples[depth]
+                depth = below + mark_pops[code]
+            else:
+                depth = _UNKNOWN_DEPTH
+        elif code == pop_code:
+            if result_codes and result_codes[-1] == dup_code:
+                result.pop()
+                result_codes.pop()
+                depth -= 1
+                continue
+            if depth == 0 and marks:
+                depth = marks.pop()[0]
+            else:
+                depth -= 1
+        elif code in put_codes and index >= first_removable:
+            memo_index = _memo_index(code, cast(bytes, encoding), 1, len(encoding))
+            if memo_index not in cast('set[int]', fetched):
+                removed.add(memo_index)
+                continue
+        else:
+            effect = effects.get(code)
+            if effect is None or effect[0] > depth:  # raw data, or items popped across a mark
+                del marks[:]
+                depth = _UNKNOWN_DEPTH
+            else:
+                depth += effect[1] - effect[0]
+        result.append(encoding)
+        result_codes.append(code)
+    return [encoding for encoding in result if encoding is not None], removed
+
+
+def _simulate(data: 'bytes | bytearray') -> int:
+    # Track the stack effects of the opcodes of a pickle, for `simulate`.
+    model = _StackModel()
+    if not model.feed(data):
+        raise ValueError('pickle exhausted before seeing STOP')
+    return model.max_total
+
+
+class _StackModel:
+    # A model of the unpickler stack, its marks and its memo, for `simulate` and for assemblers validating opcodes
+    # incrementally. Checks raise before the state is changed, and are separate from the updates, so that an opcode
+    # can be checked before it is written and applied once it has been written.
+    __slots__ = ('memo', 'marks', 'depth', 'total', 'max_total', 'nested')
+
+    def __init__(self) -> None:
+        self.memo = set()  # type: set[int]  # indices of the memo entries stored so far
+        self.marks = []  # type: list[int]  # the number of items between each mark and the mark below it
+        self.depth = 0  # the number of items above the topmost mark
+        self.total = 0  # the number of items on the stack
+        self.max_total = 0
+        self.nested = 0  # the number of opcode methods overridden by subclasses being called
+
+    def __getstate__(self) -> 'tuple[object, ...]':  # for pickling with protocols 0 and 1
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state: 'tuple[object, ...]') -> None:
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def check_pops(self, pops: int, code: int) -> None:
+        if self.depth < pops:
+            raise PickleValidationError('stack underflow at opcode {}'.format(_disassemble_table[code][0].name))
+
+    def apply(self, delta: int) -> None:
+        self.depth += delta
+        self.total += delta
+        if self.total > self.max_total:
+            self.max_total = self.total
+
+    def check_pop(self) -> None:
+        if not self.depth and not self.marks:
+            raise PickleValidationError('stack underflow at opcode POP')
+
+    def apply_pop(self) -> None:
+        if self.depth:
+            self.depth -= 1
+            self.total -= 1
+        else:  # pops the topmost mark instead
+            self.depth = self.marks.pop()
+
+    def apply_mark(self) -> None:
+        self.marks.append(self.depth)
+        self.depth = 0
+
+    def check_mark_pop(self, code: int) -> None:
+        name = _disassemble_table[code][0].name
+        if not self.marks:
+            raise PickleValidationError('MARK not found for opcode {}'.format(name))
+        if self.depth % 2 and (code == DICT[0] or code == SETITEMS[0]):
+            raise PickleValidationError('odd number of items for opcode {}'.format(name))
+        if (not self.depth and code == OBJ[0]
+                or not self.marks[-1] and (code == APPENDS[0] or code == SETITEMS[0] or code == ADDITEMS[0])):
+            raise PickleValidationError('stack underflow at opcode {}'.format(name))
+
+    def apply_mark_pop(self, code: int) -> None:
+        self.total -= self.depth
+        self.depth = self.marks.pop()
+        self.apply(_mark_pops[code])
+
+    def check_get(self, index: int, code: int) -> None:
+        if index not in self.memo:
+            raise PickleValidationError('memo entry {} is not set, at opcode {}'.format(
+                index, _disassemble_table[code][0].name))
+
+    def feed(self, data: 'bytes | bytearray') -> bool:
+        # Check and apply the opcodes of a pickle, or of a part of one made of whole opcodes, returning whether STOP
+        # has been reached (the rest of the data is then ignored). If an error is raised, the state is restored.
+        # Opcodes are walked here rather than with `disassemble`, as no instruction objects are needed.
+        sizes = _fixed_sizes
+        table = _disassemble_table
+        effects = _stack_effects
+        memo_codes = _memo_codes
+        get_codes = (GET[0], BINGET[0], LONG_BINGET[0])
+        short_memo_codes = (BINGET[0], BINPUT[0])
+        memoize_code = MEMOIZE[0]
+        mark_code = MARK[0]
+        pop_code = POP[0]
+        stop_code = STOP[0]
+        size = len(data)
+        pos = 0
+        start = 0
+        saved = self.depth, self.total, self.max_total, list(self.marks)
+        added = []  # type: list[int]  # indices of the memo entries stored for the first time
+        try:
+            while pos < size:
+                start = pos
+                code = data[pos]
+                step = sizes[code]
+                if step:  # most opcodes
+                    pos += step
+                    if pos > size:
+                        break
+                else:
+                    try:
+                        opcode, kind = table[code]
+                    except KeyError:
+                        raise ValueError('unknown opcode {!r} at position {}'.format(data[pos:pos + 1], pos)) from None
+                    pos += 1
+                    if kind <= _ARG_LONG:  # a counted argument
+                        unpack_from, width = _arg_structs[code]
+                        if pos + width > size:
+                            raise ValueError('truncated argument of opcode {} at position {}'.format(
+                                opcode.name, start))
+                        end = pos + width + unpack_from(data, pos)[0]
+                        if end > size or end < pos + width:
+                            raise ValueError('invalid argument size of opcode {} at position {}'.format(
+                                opcode.name, start))
+                        pos = end
+                    else:
+                        end = data.find(b'\n', pos)
+                        if kind == _ARG_NAMES and end >= 0:
+                            end = data.find(b'\n', end + 1)
+                        if end < 0:
+                            raise ValueError('unterminated argument of opcode {} at position {}'.format(
+                                opcode.name, start))
+                        pos = end + 1
+                if code in memo_codes:
+                    if code == memoize_code:
+                        index = len(self.memo)
+                    elif code in short_memo_codes:
+                        index = data[start + 1]
+                    else:
+                        index = _memo_index(code, data, start + 1, pos)
+                    if code in get_codes:
+                        if index not in self.memo:
+                            self.check_get(index, code)
+                        self.apply(1)
+                    else:
+                        if not self.depth:
+                            self.check_pops(1, code)
+                        if index not in self.memo:
+                            added.append(index)
+                            self.memo.add(index)
+                elif code in effects:
+                    if code == pop_code:
+                        self.check_pop()
+                        self.apply_pop()
+                        continue
+                    pops, pushes = effects[code]
+                    if pops > self.depth:
+                        self.check_pops(pops, code)
+                    if code == stop_code:
+                        return True
+                    self.depth += pushes - pops
+                    self.total += pushes - pops
+                    if self.total > self.max_total:
+                        self.max_total = self.total
+                elif code == mark_code:
+                    self.apply_mark()
+                else:
+                    self.check_mark_pop(code)
+                    self.apply_mark_pop(code)
+            if pos > size:
+                raise ValueError('truncated argument of opcode {} at position {}'.format(
+                    table[data[start]][0].name, start))
+        except (PickleValidationError, ValueError) as error:
+            self.depth, self.total, self.max_total, self.marks = saved
+            self.memo.difference_update(added)
+            if isinstance(error, PickleValidationError):
+                raise PickleValidationError('{} at position {}'.format(error, start)) from None
+            raise
+        return False
+
+
+def _encode_memo_get(proto: int, index: int) -> bytes:
+    if proto == 0:
+        return GET + str(index).encode('ascii') + b'\n'
+    if index <= 2 ** 8 - 1:
+        return _pack_opcode_u8(BINGET, index)
+    return _pack_opcode_u32(LONG_BINGET, index)
+
+
+def _encode_memo_put(proto: int, index: int, memo_size: int) -> bytes:
+    # `memo_size` is the number of memo entries at the time of the put, which MEMOIZE uses as the index.
+    if proto >= 4 and index == memo_size:
+        return MEMOIZE
+    if proto == 0:
+        return PUT + str(index).encode('ascii') + b'\n'
+    if index <= 2 ** 8 - 1:
+        return _pack_opcode_u8(BINPUT, index)
+    return _pack_opcode_u32(LONG_BINPUT, index)
+
+
+# Types of objects stored in the memo by `util_push`.
+_util_memo_types = frozenset({bytes, str, tuple, list, dict})  # type: Final[frozenset[type]]
+
+# Types of objects stored in the memo by value rather than by identity if `memoize` is ``'equality'``.
+_util_memo_value_types = frozenset({bytes, str})  # type: Final[frozenset[type]]
+
+
 def _is_opcode_method(method_name: str) -> bool:
     return any(method_name.startswith(prefix) for prefix in ('push', 'build', 'pop', 'memo'))
 
@@ -700,27 +2574,213 @@ def _method_name_to_opcode(method_name: str) -> 'Opcode':
     return cast(Opcode, ret)
 
 
-def _opcode_method_decorator(func: 'Callable[..., None]') -> 'Callable[..., None]':
-    opcode = _method_name_to_opcode(func.__name__)
-
+def _protocol_mismatch_stub(func: 'Callable[..., None]', opcode: 'Opcode', proto: int) -> 'Callable[..., None]':
     @functools.wraps(func)
-    def wrapper(self: 'PickleAssembler', *args: object, **kwargs: object) -> None:
-        if self.verify and self.proto < opcode.proto:
-            raise PickleProtocolMismatchError('opcode {} requires protocol version >= {}, '
-                                              'but current protocol is {}'.format(
-                                                  opcode.name, opcode.proto, self.proto
-                                              ))
-        return func(self, *args, **kwargs)
-
-    wrapper.__doc__ = 'Corresponds to the ``{}`` opcode.'.format(opcode.name)
-    return wrapper
-
+    def stub(*args: object, **kwargs: object) -> None:
+        raise PickleProtocolMismatchError('opcode {} requires protocol version >= {}, '
+                                          'but current protocol is {}'.format(opcode.name, opcode.proto, proto))
+
+    return stub
+
+
+def _protocol_class(cls: 'type[PickleAssembler]', proto: 'Optional[int]',
+                    validated: bool = False) -> 'type[PickleAssembler]':
+    # The subclass of an assembler class specialized for a protocol, in which opcode methods requiring a higher
+    # protocol are replaced with stubs, and for incremental validation if ``validated`` is true, in which the other
+    # opcode methods are wrapped (see `_validating_methods`), created once per class, protocol and validation; or the
+    # class itself if ``proto`` is None and ``validated`` is false.
+    cls = vars(cls).get('_protocol_base', cls)
+    if proto is None and not validated:
+        return cls
+    if '_protocol_classes' not in vars(cls):  # do not share the subclasses of base classes
+        cls._protocol_classes = {}
+    specialized = cls._protocol_classes.get((proto, validated))
+    if specialized is None:
+        namespace = dict(_protocol_mismatch_stubs[proto]) if proto is not None else {}  # type: dict[str, object]
+        if validated:
+            namespace.update(_validating_methods(cls, namespace))
+        namespace.update(__module__=cls.__module__, __qualname__=cls.__qualname__, __doc__=cls.__doc__,
+                         _protocol_base=cls)
+        specialized = cast('type[PickleAssembler]', type(cls.__name__, (cls,), namespace))
+        cls._protocol_classes[proto, validated] = specialized
+    return specialized
+
+
+def _new_assembler(cls: 'type[PickleAssembler]', proto: int, verify: bool,
+                   validate: 'Optional[str]' = None) -> 'PickleAssembler':
+    # Create an assembler without initializing it, for unpickling.
+    return cls.__new__(cls, proto, verify, validate=validate)
+
+
+def _validating_method(method: 'Callable[..., None]', opcode: 'Opcode') -> 'Callable[..., None]':
+    # Wrap an opcode method for assemblers validating opcodes incrementally: the opcode is checked against their
+    # stack model before the method writes it, and applied to the model afterwards. As this runs for every opcode,
+    # the common cases are inlined, and methods without arguments are called without forwarding any. The assembler
+    # is typed as Any, as its stack model is known to be set.
+    code = opcode[0]
+    no_args = getattr(method, '__wrapped__', method).__code__.co_argcount == 1
+    if code == MEMOIZE[0]:
+        def validating(self: 'Any') -> None:
+            model = self._stack_model  # pylint: disable=protected-access
+            model.check_pops(1, code)
+            method(self)
+            model.memo.add(len(model.memo))
+    elif code in (PUT[0], BINPUT[0], LONG_BINPUT[0]):
+        def validating(self: 'Any', index: int) -> None:  # type: ignore[misc]
+            model = self._stack_model  # pylint: disable=protected-access
+            model.check_pops(1, code)
+            method(self, index)
+            model.memo.add(index)
+    elif code in _memo_codes:
+        def validating(self: 'Any', index: int) -> None:  # type: ignore[misc]
+            model = self._stack_model  # pylint: disable=protected-access
+            if isinstance(index, int):  # otherwise the method raises
+                model.check_get(index, code)
+            method(self, index)
+            model.apply(1)
+    elif code == MARK[0]:
+        def validating(self: 'Any') -> None:
+            model = self._stack_model  # pylint: disable=protected-access
+            method(self)
+            model.marks.append(model.depth)
+            model.depth = 0
+    elif code == POP[0]:
+        def validating(self: 'Any') -> None:
+            model = self._stack_model  # pylint: disable=protected-access
+            model.check_pop()
+            method(self)
+            model.apply_pop()
+    elif code not in _stack_effects:  # pops a mark
+        pushes = _mark_pops[code]
+        checked = code in (DICT[0], SETITEMS[0], OBJ[0], APPENDS[0], ADDITEMS[0])  # has further checks
+        if no_args:
+            def validating(self: 'Any') -> None:
+                model = self._stack_model  # pylint: disable=protected-access
+                if checked or not model.marks:
+                    model.check_mark_pop(code)
+                method(self)
+                model.total += pushes - model.depth
+                model.depth = model.marks.pop() + pushes
+                if model.total > model.max_total:
+                    model.max_total = model.total
+        else:
+            def validating(self: 'Any', *args: object) -> None:  # type: ignore[misc]
+                model = self._stack_model  # pylint: disable=protected-access
+                if checked or not model.marks:
+                    model.check_mark_pop(code)
+                method(self, *args)
+                model.total += pushes - model.depth
+                model.depth = model.marks.pop() + pushes
+                if model.total > model.max_total:
+                    model.max_total = model.total
+    else:
+        pops, pushes = _stack_effects[code]
+        delta = pushes - pops
+        if no_args:
+            def validating(self: 'Any') -> None:
+                model = self._stack_model  # pylint: disable=protected-access
+                if model.depth < pops:
+                    model.check_pops(pops, code)
+                method(self)
+                model.depth += delta
+                model.total += delta
+                if model.total > model.max_total:
+                    model.max_total = model.total
+        else:
+            def validating(self: 'Any', *args: object, **kwargs: object) -> None:  # type: ignore[misc]
+                model = self._stack_model  # pylint: disable=protected-access
+                if model.depth < pops:
+                    model.check_pops(pops, code)
+                method(self, *args, **kwargs)
+                model.depth += delta
+                model.total += delta
+                if model.total > model.max_total:
+                    model.max_total = model.total
+
+    return functools.wraps(method)(validating)
+
+
+def _nesting_method(method: 'Callable[..., None]') -> 'Callable[..., None]':
+    # Wrap an opcode method overridden by a subclass, so that it is validated as the opcode it is named after,
+    # whichever opcode methods it calls to write it: these are not validated while it runs (see `_nested_method`).
+    @functools.wraps(method)
+    def nesting(self: 'Any', *args: object, **kwargs: object) -> None:
+        model = self._stack_model  # pylint: disable=protected-access
+        model.nested += 1
+        try:
+            method(self, *args, **kwargs)
+        finally:
+            model.nested -= 1
+
+    return nesting
+
+
+def _nested_method(validating: 'Callable[..., None]', method: 'Callable[..., None]') -> 'Callable[..., None]':
+    # Wrap a validating wrapper of an assembler class which overrides opcode methods, so that the wrapped method is
+    # called directly while an overridden method runs.
+    @functools.wraps(validating)
+    def nested(self: 'Any', *args: object, **kwargs: object) -> None:
+        if self._stack_model.nested:  # pylint: disable=protected-access
+            method(self, *args, **kwargs)
+        else:
+            validating(self, *args, **kwargs)
+
+    return nested
+
+
+def _validating_methods(cls: 'type[PickleAssembler]', stubs: 'dict[str, object]') -> 'dict[str, Callable[..., None]]':
+    # The wrappers of the opcode methods of an assembler class updating `_stack_model`, for the subclass validating
+    # opcodes incrementally (except for the stubs of opcodes requiring a higher protocol).
+    methods = {
+        method_name: (getattr(cls, method_name), opcode)
+        for method_name, opcode in _validated_methods.items()
+        if method_name not in stubs
+    }
+    overridden = {
+        method_name for method_name, (method, _) in methods.items()
+        if method is not getattr(PickleAssembler, method_name)
+    }
+    wrappers = {}  # type: dict[str, Callable[..., None]]
+    for method_name, (method, opcode) in methods.items():
+        if method_name in overridden:
+            method = _nesting_method(method)
+        validating = _validating_method(method, opcode)
+        if overridden:
+            validating = _nested_method(validating, method)
+        wrappers[method_name] = validating
+    return wrappers
+
+
+_opcode_methods = {}  # type: dict[str, tuple[Callable[..., None], Opcode]]
 
 for _method_name in dir(PickleAssembler):
     if _is_opcode_method(_method_name):
         _method = getattr(PickleAssembler, _method_name)
-        setattr(PickleAssembler, _method_name, _opcode_method_decorator(_method))
-
-del _method_name, _method  # pylint: disable=undefined-loop-variable
-
-__all__ = ['PickleAssembler', 'PickleProtocolMismatchError', 'HIGHEST_PROTOCOL']
+        _opcode = _method_name_to_opcode(_method_name)
+        _method.__doc__ = 'Corresponds to the ``{}`` opcode.'.format(_opcode.name)
+        _opcode_methods[_method_name] = (_method, _opcode)
+
+del _method_name, _method, _opcode  # pylint: disable=undefined-loop-variable
+
+# Stubs of the opcode methods requiring a higher protocol than each protocol, for the classes specialized for it.
+_protocol_mismatch_stubs = {
+    proto: {
+        method_name: _protocol_mismatch_stub(method, opcode, proto)
+        for method_name, (method, opcode) in _opcode_methods.items()
+        if opcode.proto > proto
+    }
+    for proto in range(HIGHEST_PROTOCOL + 1)
+}  # type: Final[dict[int, dict[str, Callable[..., None]]]]
+
+# Methods wrapped for assemblers validating opcodes incrementally, with their opcodes. Strings are pushed by the
+# helpers of the ``*BINUNICODE*`` methods (which `util_push` calls directly), so the helpers are wrapped instead.
+_validated_methods = {
+    method_name: opcode for method_name, (_, opcode) in _opcode_methods.items()
+}  # type: Final[dict[str, Opcode]]
+for _method_name in ('push_binunicode', 'push_binunicode8', 'push_short_binunicode'):
+    _validated_methods['_{}_encoded'.format(_method_name)] = _validated_methods.pop(_method_name)
+
+del _method_name  # pylint: disable=undefined-loop-variable
+
+__all__ = ['PickleAssembler', 'MemoAllocator', 'PickleProtocolMismatchError', 'PickleValidationError', 'PickleIR',
+           'Instruction', 'disassemble', 'optimize_memo', 'simulate', 'HIGHEST_PROTOCOL']
@@ -1,17 +1,27 @@
+import array
+import copy
+import gc
+import io
+import mmap
+import os
 import pickle  # nosec
+import pickletools
 import re
+import socket
 import struct
+import sys
 import unittest
 from typing import cast
 
 from typing_extensions import TYPE_CHECKING
 
-from pickleassem import (BINBYTES, BINFLOAT, BININT, BININT1, BININT2, BINUNICODE, DICT,  # nosec
-                         EMPTY_DICT, EMPTY_LIST, EMPTY_TUPLE, FLOAT, HIGHEST_PROTOCOL, INT, LIST,
-                         LONG1, LONG4, MARK, NEWFALSE, NONE, PROTO, SHORT_BINBYTES,
-                         SHORT_BINUNICODE, TRUE, TUPLE, TUPLE1, TUPLE2, TUPLE3, UNICODE, Opcode,
-                         PickleAssembler, PickleProtocolMismatchError, _is_opcode_method,
-                         _method_name_to_opcode, p8, p16, p32, p64, pack)
+from pickleassem import (APPEND, APPENDS, BINBYTES, BINFLOAT, BINGET, BININT, BININT1, BININT2, BINPUT,  # nosec
+                         BINUNICODE, DICT, EMPTY_DICT, EMPTY_LIST, EMPTY_TUPLE, FLOAT, FRAME, GLOBAL, HIGHEST_PROTOCOL,
+                         INT, LIST, LONG, LONG1, LONG4, MARK, MEMOIZE, NEWFALSE, NEXT_BUFFER, NONE, PROTO, PUT,
+                         READONLY_BUFFER, SETITEM, SETITEMS, SHORT_BINBYTES, SHORT_BINUNICODE, STACK_GLOBAL, STOP,
+                         STRING, TRUE, TUPLE, TUPLE1, TUPLE2, TUPLE3, UNICODE, Instruction, Opcode, PickleAssembler,
+                         PickleIR, PickleProtocolMismatchError, PickleValidationError, _is_opcode_method,
+                         _method_name_to_opcode, disassemble, optimize_memo, p8, p16, p32, p64, pack, simulate)
 
 if TYPE_CHECKING:
     from collections.abc import Callable
@@ -44,6 +54,28 @@ class TestPickleAssembler(unittest.TestCase):
             pa = PickleAssembler(proto=HIGHEST_PROTOCOL + 1)
         with self.assertRaisesRegex(TypeError, re.escape('verify must be bool')):
             pa = PickleAssembler(proto=0, verify='x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(TypeError, re.escape('ir must be bool')):
+            pa = PickleAssembler(proto=0, ir='x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(TypeError, re.escape('buffer size should be an integer')):
+            pa = PickleAssembler(proto=0, buffer_size='x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(ValueError, re.escape('buffer size should be positive')):
+            pa = PickleAssembler(proto=0, buffer_size=0)
+        with self.assertRaisesRegex(TypeError, re.escape('batch size should be an integer')):
+            pa = PickleAssembler(proto=0, batch_size='x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(ValueError, re.escape('batch size should be positive')):
+            pa = PickleAssembler(proto=0, batch_size=0)
+        with self.assertRaisesRegex(ValueError, re.escape("memoize should be None, 'identity' or 'equality'")):
+            pa = PickleAssembler(proto=0, memoize='x')
+        with self.assertRaisesRegex(TypeError, re.escape('frame size should be an integer')):
+            pa = PickleAssembler(proto=4, frame_size='x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(ValueError, re.escape('frame size should be positive')):
+            pa = PickleAssembler(proto=4, frame_size=0)
+        with self.assertRaisesRegex(ValueError, re.escape('framing requires protocol version >= 4')):
+            pa = PickleAssembler(proto=3, frame_size=1)
+        with self.assertRaisesRegex(ValueError, re.escape("validate should be None, 'assemble' or 'incremental'")):
+            pa = PickleAssembler(proto=0, validate='x')
+        with self.assertRaisesRegex(ValueError, re.escape("validate='assemble' cannot be used with a sink")):
+            pa = PickleAssembler(proto=0, sink=io.BytesIO(), validate='assemble')
 
         pa = PickleAssembler(proto=2, verify=False)
         self.assertEqual(pa.proto, 2)
@@ -59,6 +91,708 @@ class TestPickleAssembler(unittest.TestCase):
         pa = PickleAssembler(proto=0)
         pa.push_none()
         self.assertEqual(pa.assemble(), NONE + b'.')
+        self.assertIs(type(pa.assemble()), bytes)
+        self.assertEqual(pa.assemble(), NONE + b'.')  # assembling does not modify the payload
+
+    def test_view(self) -> None:
+        pa = PickleAssembler(proto=0)
+        pa.push_none()
+        with pa.view() as view:
+            self.assertEqual(view, NONE + b'.')
+            if hasattr(memoryview, 'toreadonly'):  # new in Python 3.8
+                self.assertTrue(view.readonly)
+            with self.assertRaisesRegex(BufferError, re.escape('must be released before modifying the assembler')):
+                pa.push_none()
+        with pa.view() as view:
+            self.assertEqual(view, NONE + b'.')
+        self.assertEqual(pa.assemble(), NONE + b'.')
+
+        pa.push_none()
+        with pa.view() as view:
+            self.assertEqual(view, NONE + NONE + b'.')
+        self.assertEqual(pa.assemble(), NONE + NONE + b'.')
+
+    def test_copy(self) -> None:
+        for kwargs in ({}, {'ir': True}, {'memoize': 'identity'}, {'frame_size': 4}, {'buffer_size': 16},
+                       {'validate': 'incremental'}):
+            for copier in (copy.copy, copy.deepcopy):
+                with self.subTest(kwargs=kwargs, copier=copier):
+                    pa = PickleAssembler(proto=4, **kwargs)
+                    shared = [b'x' * 100]
+                    pa.push_mark()
+                    pa.util_push([shared, shared])
+                    template = pa.assemble()
+                    copied = copier(pa)
+                    for _ in range(2):
+                        copied.push_none()
+                    copied.build_tuple()
+                    self.assertEqual(pa.assemble(), template)
+                    self.assertEqual(pickle.loads(copied.assemble()), ([[b'x' * 100]] * 2, None, None))
+                    pa.push_true()
+                    pa.build_tuple()
+                    self.assertEqual(pickle.loads(pa.assemble()), ([[b'x' * 100]] * 2, True))
+
+        pa = PickleAssembler(proto=2)
+        pa.push_none()
+        with pa.view():
+            pass
+        copied = copy.deepcopy(pa)
+        copied.push_none()
+        copied.push_none()
+        self.assertEqual(pa.assemble(), PROTO + p8(2) + NONE + STOP)
+        self.assertEqual(copied.assemble(), PROTO + p8(2) + NONE * 3 + STOP)
+
+        pa = PickleAssembler.from_bytes(pickle.dumps((1, 2), protocol=2))
+        copied = copy.copy(pa)
+        with copied.replace_loaded(1):
+            copied.push_binint1(3)
+        self.assertEqual(pickle.loads(pa.assemble()), (1, 2))
+        self.assertEqual(pickle.loads(copied.assemble()), (3, 2))
+
+        with self.assertRaisesRegex(TypeError, re.escape('cannot copy an assembler writing to a sink')):
+            copy.copy(PickleAssembler(proto=0, sink=io.BytesIO()))
+
+    def test_assemble_into(self) -> None:
+        pa = PickleAssembler(proto=0)
+        pa.push_none()
+        buf = bytearray(b'xxxxx')
+        self.assertEqual(pa.assemble_into(buf, 1), 3)
+        self.assertEqual(buf, b'x' + NONE + b'.xx')
+
+        with pa.view():
+            pass
+        self.assertEqual(pa.assemble_into(memoryview(buf)[3:]), 2)
+        self.assertEqual(buf, b'x' + NONE + b'.' + NONE + b'.')
+
+        with self.assertRaisesRegex(ValueError, re.escape('buffer too small to hold the assembled payload')):
+            pa.assemble_into(buf, 4)
+        with self.assertRaisesRegex(ValueError, re.escape('buffer too small to hold the assembled payload')):
+            pa.assemble_into(buf, -1)
+        with self.assertRaisesRegex(TypeError, re.escape('buffer should be writable')):
+            pa.assemble_into(b'xxxxx')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(TypeError, re.escape('offset should be an integer')):
+            pa.assemble_into(buf, '1')  # type: ignore[arg-type]
+
+    def test_sink(self) -> None:
+        class RecordingSink(io.BytesIO):
+            def __init__(self) -> None:
+                super().__init__()
+                self.write_sizes = []  # type: list[int]
+
+            def write(self, data: 'bytes | bytearray | memoryview') -> int:  # type: ignore[override]
+                self.write_sizes.append(len(data))
+                return super().write(data)
+
+        sink = RecordingSink()
+        pa = PickleAssembler(proto=4, sink=sink, buffer_size=16)
+        pa.push_mark()
+        for i in range(10):
+            pa.push_binint1(i)
+        pa.push_binbytes8(b'x' * 100)
+        pa.build_tuple()
+        self.assertEqual(sink.write_sizes, [17, 15, 100])
+        self.assertEqual(pa.assemble(), b'')
+        self.assertEqual(sink.write_sizes, [17, 15, 100, 2])
+        self.assertEqual(pickle.loads(sink.getvalue()), tuple(range(10)) + (b'x' * 100,))
+        self.assertEqual(pa.assemble(), b'')
+        self.assertEqual(sink.write_sizes, [17, 15, 100, 2])
+        with self.assertRaisesRegex(ValueError, re.escape('payload has already been written to the sink')):
+            pa.push_none()
+        with self.assertRaisesRegex(ValueError, re.escape('payload has already been written to the sink')):
+            pa.append_raw(NONE)
+        self.assertEqual(sink.write_sizes, [17, 15, 100, 2])
+
+        with self.assertRaisesRegex(ValueError, re.escape('payload is not kept in memory when writing to a sink')):
+            pa.view()
+        with self.assertRaisesRegex(ValueError, re.escape('payload is not kept in memory when writing to a sink')):
+            pa.assemble_into(bytearray(100))
+
+        class ChunkSink:  # keeps the objects it is given instead of copying them
+            def __init__(self) -> None:
+                self.chunks = []  # type: list[bytes | bytearray | memoryview]
+
+            def write(self, data: 'bytes | bytearray | memoryview') -> int:
+                self.chunks.append(data)
+                return len(data)
+
+        for frame_size in [None, 16]:
+            with self.subTest(frame_size=frame_size):
+                chunk_sink = ChunkSink()
+                pa = PickleAssembler(proto=4, sink=chunk_sink, buffer_size=16,  # type: ignore[arg-type]
+                                     frame_size=frame_size)
+                pa.util_push(list(range(100)))
+                pa.assemble()
+                self.assertGreater(len(chunk_sink.chunks), 2)
+                self.assertEqual(pickle.loads(b''.join(chunk_sink.chunks)), list(range(100)))
+
+    def test_vectored_output(self) -> None:
+        pa = PickleAssembler(proto=4, buffer_size=16)
+        pa.push_mark()
+        for i in range(3):
+            pa.push_binbytes(bytes([i]) * 20)
+        pa.build_tuple()
+        payload = pa.assemble()
+
+        read_fd, write_fd = os.pipe()
+        try:
+            self.assertEqual(pa.write_to_fd(write_fd), len(payload))
+            self.assertEqual(os.read(read_fd, len(payload) + 1), payload)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+        sock1, sock2 = socket.socketpair()
+        with sock1, sock2:
+            self.assertEqual(pa.send_to_socket(sock1), len(payload))
+            sock1.shutdown(socket.SHUT_WR)
+            received = b''
+            while len(received) <= len(payload):
+                data = sock2.recv(len(payload))
+                if not data:
+                    break
+                received += data
+            self.assertEqual(received, payload)
+
+        chunks = []  # type: list[bytes]
+
+        def write_some(buffers: 'list[memoryview]') -> int:  # partial writes
+            chunk = b''.join(buffers)[:7]
+            chunks.append(chunk)
+            return len(chunk)
+
+        with pa.view():
+            self.assertEqual(pa._write_vectored(write_some), len(payload))  # pylint: disable=protected-access
+        self.assertEqual(b''.join(chunks), payload)
+
+        with self.assertRaisesRegex(TypeError, re.escape('file descriptor should be an integer')):
+            pa.write_to_fd('x')  # type: ignore[arg-type]
+        pa = PickleAssembler(proto=4, sink=io.BytesIO())
+        with self.assertRaisesRegex(ValueError, re.escape('payload is not kept in memory when writing to a sink')):
+            pa.write_to_fd(1)
+
+    def test_referenced_arguments(self) -> None:
+        data = bytearray(b'x' * 16)
+        pa = PickleAssembler(proto=4, buffer_size=16, memoize='identity')
+        pa.push_mark()
+        pa.push_binbytes(data)
+        pa.push_short_binbytes(memoryview(b'abcd')[::2])
+        pa.push_binbytes8(array.array('H', [0x6261] * 8))
+        pa.util_push([b'y' * 20] * 2)
+        pa.build_tuple()
+        data[0] = ord('z')  # large arguments are referenced by the payload until it is assembled
+        expected = (b'z' + b'x' * 15, b'ac', b'ab' * 8, [b'y' * 20] * 2)
+        payload = pa.assemble()
+        self.assertEqual(pickle.loads(payload), expected)
+        buf = bytearray(len(payload) + 1)
+        self.assertEqual(pa.assemble_into(buf, 1), len(buf))
+        self.assertEqual(buf[1:], payload)
+        with pa.view() as view:
+            self.assertEqual(view, payload)
+        data[0] = ord('x')  # view() copies referenced arguments
+        self.assertEqual(pa.assemble(), payload)
+
+        pa = PickleAssembler(proto=4, buffer_size=16, frame_size=4)
+        pa.push_mark()
+        pa.push_binbytes(data)
+        pa.push_binint1(1)
+        pa.push_binint1(2)
+        pa.build_tuple()
+        payload = pa.assemble()
+        with pa.view() as view:
+            self.assertEqual(view, payload)
+        self.assertEqual(pickle._loads(payload), (b'x' * 16, 1, 2))  # type: ignore[attr-defined]
+
+        pa = PickleAssembler(proto=4, buffer_size=16)
+        with mmap.mmap(-1, 32) as mapped:
+            mapped.write(b'm' * 32)
+            pa.util_push(mapped)
+            self.assertEqual(pickle.loads(pa.assemble()), b'm' * 32)
+
+        pa = PickleAssembler(proto=4)
+        with self.assertRaisesRegex(PickleProtocolMismatchError,
+                                    re.escape('must use at least protocol 5 to push bytearray')):
+            pa.util_push(bytearray(b'x'))
+        if DEFAULT_TEST_PROTO >= 5:  # pragma: no cover
+            pa = PickleAssembler(proto=5)
+            pa.util_push(bytearray(b'x'))
+            self.assertEqual(pickle.loads(pa.assemble()), bytearray(b'x'))
+
+    def test_framing(self) -> None:
+        pa = PickleAssembler(proto=4, frame_size=4)
+        pa.push_mark()
+        for i in range(3):
+            pa.push_binint1(i)
+        pa.push_binbytes(b'x' * 4)
+        pa.push_binint1(3)
+        pa.build_tuple()
+        payload = pa.assemble()
+        self.assertEqual(payload, PROTO + p8(4) + FRAME + p64(5) + MARK + BININT1 + p8(0) + BININT1 + p8(1)
+                         + FRAME + p64(7) + BININT1 + p8(2) + BINBYTES + p32(4) + b'xxxx'
+                         + FRAME + p64(4) + BININT1 + p8(3) + TUPLE + b'.')
+        self.assertEqual(pickle.loads(payload), (0, 1, 2, b'xxxx', 3))
+        with pa.view() as view:
+            self.assertEqual(view, payload)
+        buf = bytearray(len(payload))
+        self.assertEqual(pa.assemble_into(buf), len(payload))
+        self.assertEqual(buf, payload)
+
+        obj = ['x' * 1000, b'y' * 100, 'z\n' * 100, list(range(300)), {'a': (1.5, None)}]
+        for frame_size in [1, 64, 1024, 64 * 1024]:
+            for use_sink in [False, True]:
+                with self.subTest(frame_size=frame_size, use_sink=use_sink):
+                    sink = io.BytesIO()
+                    pa = PickleAssembler(proto=4, sink=sink if use_sink else None, frame_size=frame_size)
+                    pa.util_push(obj)
+                    pa.push_unicode('z\n' * 100)
+                    pa.pop()
+                    pa.push_global('builtins', 'len')
+                    pa.pop()
+                    payload = pa.assemble() if not use_sink else pa.assemble() + sink.getvalue()
+                    self.assertEqual(pickle.loads(payload), obj)
+                    self.assertEqual(pickle._loads(payload), obj)  # type: ignore[attr-defined]  # checks frames
+                    frame_sizes = [cast(int, arg) for opcode, arg, _ in pickletools.genops(payload)
+                                   if opcode.name == 'FRAME']
+                    self.assertTrue(frame_sizes)
+                    self.assertTrue(all(size < frame_size + 1000 for size in frame_sizes))
+
+    def test_disassemble(self) -> None:
+        obj = [0, -1, 300, 70000, 2 ** 40, -2 ** 3000, 1.5, 'a\n\\', '\u4e2d' * 100, b'xy', b'z' * 300, (1, 2),
+               {'a': None}, True, False, SampleClass(1)]
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(proto=proto):
+                payload = pickle.dumps(obj, protocol=proto)
+                instructions = disassemble(payload)
+                expected = list(pickletools.genops(payload))
+                self.assertEqual([(cast(Opcode, inst.opcode).name, inst.pos) for inst in instructions],
+                                 [(opcode.name, pos) for opcode, _, pos in expected])
+                for inst, (_, arg, _) in zip(instructions, expected):
+                    self.assertIsInstance(inst.opcode, Opcode)
+                    if isinstance(inst.arg, memoryview):
+                        self.assertIs(inst.arg.obj, payload)  # not copied
+                    elif isinstance(inst.arg, tuple):
+                        self.assertEqual(' '.join(inst.arg), arg)
+                    else:
+                        self.assertEqual(inst.arg, arg)
+
+        pa = PickleAssembler(proto=0)
+        pa.push_global('os', 'system')
+        pa.push_unicode('\u4e2d\n')
+        pa.push_long(-5)
+        pa.push_string('x')
+        pa.memo_put(1)
+        self.assertEqual(disassemble(bytearray(pa.assemble())), [
+            Instruction(GLOBAL, ('os', 'system'), 0), Instruction(UNICODE, memoryview(b'\\u4e2d\\u000a'), 11),
+            Instruction(LONG, -5, 25), Instruction(STRING, memoryview(b"'x'"), 29), Instruction(PUT, 1, 34),
+            Instruction(STOP, None, 37)])
+        self.assertEqual(disassemble(memoryview(b'K\x01.'))[0], Instruction(BININT1, 1, 0))
+        self.assertNotEqual(Instruction(STOP, None, 0), (STOP, None, 0))
+        self.assertEqual(repr(Instruction(BININT1, 1, 0)), 'Instruction(BININT1, 1, 0)')
+
+        errors = [
+            (b'\xff.', 'unknown opcode'),
+            (b'J\x00', 'truncated argument of opcode BININT at position 0'),
+            (b'N\x8c\x05ab.', 'invalid argument size of opcode SHORT_BINUNICODE at position 1'),
+            (b'I12', 'unterminated argument of opcode INT at position 0'),
+            (b'cos\nsystem', 'unterminated argument of opcode GLOBAL at position 0'),
+            (b'N', 'pickle exhausted before seeing STOP'),
+        ]  # type: list[tuple[bytes, str]]
+        for payload, msg in errors:
+            with self.subTest(payload=payload):
+                with self.assertRaisesRegex(ValueError, re.escape(msg)):
+                    disassemble(payload)
+
+        # The garbage collector is paused while disassembling, and left as it was found.
+        self.assertTrue(gc.isenabled())
+        disassemble(b'N.')
+        self.assertTrue(gc.isenabled())
+        with self.assertRaises(ValueError):
+            disassemble(b'N')
+        self.assertTrue(gc.isenabled())
+        gc.disable()
+        try:
+            disassemble(b'N.')
+            self.assertFalse(gc.isenabled())
+        finally:
+            gc.enable()
+
+    def test_from_bytes(self) -> None:
+        obj = {'name': 'x', 'items': list(range(1000)), 'cls': SampleClass}
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(proto=proto):
+                payload = pickle.dumps(obj, protocol=proto)
+                pa = PickleAssembler.from_bytes(payload)
+                self.assertEqual(pa.proto, max(proto, 1 if proto else 0))
+                self.assertEqual(pa.assemble(), payload)
+                instructions = pa.loaded_instructions
+                self.assertEqual(instructions, disassemble(payload)[:-1])
+                index = next(index for index, instruction in enumerate(instructions)
+                             if isinstance(instruction.arg, memoryview) and bytes(instruction.arg) == b'x')
+                with pa.replace_loaded(index):
+                    pa.util_push('y' * 100)
+                index = next(index for index, instruction in enumerate(instructions)
+                             if isinstance(instruction.arg, tuple) or instruction.opcode is STACK_GLOBAL)
+                # STACK_GLOBAL is preceded by 2 strings, each stored in the memo
+                with pa.replace_loaded(index - 4 if proto >= 4 else index, index + 1):
+                    pa.push_global('builtins', 'len')
+                expected = dict(obj, name='y' * 100, cls=len)
+                self.assertEqual(pickle.loads(pa.assemble()), expected)
+                self.assertEqual(pickle._loads(pa.assemble()), expected)  # type: ignore[attr-defined]  # checks frames
+                pa.pop()
+                pa.util_push(1)
+                self.assertEqual(pickle._loads(pa.assemble()), 1)  # type: ignore[attr-defined]
+                with pa.view() as view:
+                    self.assertEqual(view, pa.assemble())
+                with self.assertRaisesRegex(ValueError, re.escape('no loaded payload to replace')):
+                    with pa.replace_loaded(0):
+                        pass  # pragma: no cover
+
+        for proto in range(DEFAULT_TEST_PROTO + 1):  # memo entries are allocated after those of the loaded payload
+            with self.subTest(proto=proto):
+                pa = PickleAssembler.from_bytes(pickle.dumps(['a', 'b'], protocol=proto))
+                pa.pop()
+                pa.push_none()
+                handle = pa.memo_allocator.put()
+                pa.pop()
+                pa.memo_allocator.get(handle)
+                self.assertIsNone(pickle.loads(pa.assemble()))
+                pa.optimize()
+                pa.pop()
+                pa.push_int(True)
+                handle = pa.memo_allocator.put()
+                pa.pop()
+                pa.memo_allocator.get(handle)
+                self.assertIs(pickle.loads(pa.assemble()), True)
+
+        pa = PickleAssembler.from_bytes(bytearray(b'K\x01K\x02\x86.'))
+        self.assertEqual(pa.proto, 2)
+        self.assertEqual(pa.assemble(), BININT1 + p8(1) + BININT1 + p8(2) + TUPLE2 + b'.')
+        with pa.replace_loaded(1, 1):
+            pa.push_binint1(3)
+            pa.build_tuple2()
+        with self.assertRaisesRegex(RuntimeError, 'x'):
+            with pa.replace_loaded(2):
+                raise RuntimeError('x')
+        self.assertEqual(pickle.loads(pa.assemble()), ((1, 3), 2))
+        with self.assertRaisesRegex(ValueError, re.escape('instructions have already been replaced')):
+            with pa.replace_loaded(1):
+                pass  # pragma: no cover
+        with self.assertRaisesRegex(ValueError, re.escape('instructions have already been replaced')):
+            with pa.replace_loaded(0, 2):
+                pass  # pragma: no cover
+        with self.assertRaisesRegex(IndexError, re.escape('instruction index out of range')):
+            with pa.replace_loaded(3):
+                pass  # pragma: no cover
+        with self.assertRaisesRegex(TypeError, re.escape('instruction indices should be integers')):
+            with pa.replace_loaded('x'):  # type: ignore[arg-type]
+                pass  # pragma: no cover
+        self.assertEqual(PickleAssembler(proto=0).loaded_instructions, [])
+
+    def test_ir(self) -> None:
+        obj = [1, 'x' * 100000, {'key': (None, 2.5)}, b'y' * 100000, 'x' * 100000]
+        for kwargs in ({}, {'frame_size': 64}, {'memoize': 'identity'}):
+            with self.subTest(**kwargs):
+                pa = PickleAssembler(proto=DEFAULT_TEST_PROTO, **kwargs)
+                pa.util_push(obj)
+                pa_ir = PickleAssembler(proto=DEFAULT_TEST_PROTO, ir=True, **kwargs)
+                pa_ir.util_push(obj)
+                ir = cast(PickleIR, pa_ir.ir)
+                self.assertEqual(len(ir), len(ir.codes))
+                self.assertEqual(bytes(ir.codes), b''.join(instruction.opcode.code  # type: ignore[union-attr]
+                                                           for instruction in ir))
+                self.assertEqual(pa_ir.assemble(), pa.assemble())
+                with pa_ir.view() as view:
+                    self.assertEqual(view, pa.assemble())
+                pa.util_push(3)
+                pa_ir.util_push(3)
+                self.assertEqual(pa_ir.assemble(), pa.assemble())
+                sink = io.BytesIO()
+                pa_sink = PickleAssembler(proto=DEFAULT_TEST_PROTO, sink=sink, ir=True, **kwargs)
+                pa_sink.util_push(obj)
+                self.assertEqual(sink.getvalue(), b'')
+                pa_sink.util_push(3)
+                pa_sink.assemble()
+                self.assertEqual(sink.getvalue(), pa.assemble())
+
+        pa = PickleAssembler(proto=2, ir=True)
+        pa.push_binint1(1)
+        pa.append_raw(b'')
+        pa.append_raw(BININT1 + p8(2))
+        pa.push_unicode('a\n')
+        pa.push_global('os', 'system')
+        pa.build_tuple3()
+        ir = cast(PickleIR, pa.ir)
+        self.assertEqual(list(ir), [Instruction(BININT1, 1, 0), Instruction(None, BININT1 + p8(2), 1),
+                                    Instruction(UNICODE, b'a\\u000a', 2), Instruction(GLOBAL, ('os', 'system'), 3),
+                                    Instruction(TUPLE3, None, 4)])
+        self.assertEqual(ir[-1], Instruction(TUPLE3, None, 4))
+        self.assertEqual(repr(ir[1]), "Instruction(None, b'K\\x02', 1)")
+        with self.assertRaises(IndexError):
+            ir[5]  # pylint: disable=pointless-statement
+        with self.assertRaisesRegex(TypeError, re.escape('instruction index should be an integer')):
+            ir['x']  # type: ignore[index]  # pylint: disable=pointless-statement
+        self.assertEqual(pa.assemble(), b'\x80\x02K\x01K\x02Va\\u000a\ncos\nsystem\n\x87.')
+        self.assertIsNone(PickleAssembler(proto=2).ir)
+
+    def test_optimize(self) -> None:
+        for ir in (False, True):
+            for proto, expected in ((1, b'()K\x01(K\x05tt.'), (2, b'\x80\x02)K\x01K\x05\x85\x87.')):
+                with self.subTest(ir=ir, proto=proto):
+                    pa = PickleAssembler(proto=proto, ir=ir)
+                    pa.push_mark()
+                    pa.push_mark()
+                    pa.build_tuple()
+                    pa.push_binint1(1)
+                    pa.memo_binput(0)
+                    pa.build_dup()
+                    pa.build_dup()
+                    pa.pop()
+                    pa.pop()
+                    pa.push_mark()
+                    pa.push_binint1(5)
+                    pa.build_tuple()
+                    pa.build_tuple()
+                    size = len(pa.assemble())
+                    self.assertEqual(pa.optimize(), size - len(expected))
+                    self.assertEqual(pa.assemble(), expected)
+                    self.assertEqual(pa.optimize(), 0)
+                    self.assertEqual(pickle.loads(expected), ((), 1, (5,)))
+
+        obj = [('x', 1), 'x', ('x',), [(), {'key': (1, 2, 3, 4)}], 'y' * 100000]
+        for kwargs in ({}, {'ir': True}, {'frame_size': 64}, {'sink': True, 'ir': True}):
+            for proto in range(DEFAULT_TEST_PROTO + 1):
+                if kwargs.get('frame_size') and proto < 4:
+                    continue
+                with self.subTest(proto=proto, **kwargs):
+                    sink = io.BytesIO()
+                    pa = PickleAssembler(proto=proto, memoize='identity',
+                                         **dict(kwargs, sink=sink if kwargs.get('sink') else None))  # type: ignore
+                    pa.util_push(obj)
+                    handle = pa.memo_allocator.put()
+                    pa.memo_allocator.get(handle)
+                    pa.pop()
+                    saved = pa.optimize()
+                    pa.util_push(obj[0])
+                    pa.pop()
+                    pa.memo_allocator.get(handle)
+                    payload = pa.assemble() or sink.getvalue()
+                    self.assertEqual(pickle._loads(payload), obj)  # type: ignore[attr-defined]  # checks frames
+                    if proto < 4:  # entries stored with MEMOIZE are kept
+                        self.assertGreater(saved, 0)
+                        # for 'x', the handle and the tuple pushed again
+                        self.assertEqual(payload.count(BINPUT if proto else PUT), 3)
+                        with self.assertRaisesRegex(ValueError, re.escape('memo entry has been removed by optimize')):
+                            pa.memo_allocator.get(0)
+                    if kwargs.get('sink'):
+                        with self.assertRaisesRegex(ValueError, re.escape('payload has already been written')):
+                            pa.optimize()
+
+        payload = pickle.dumps(obj, protocol=2)
+        pa = PickleAssembler.from_bytes(payload)
+        self.assertEqual(pa.optimize(), len(payload) - len(pa.assemble()))
+        self.assertEqual(pickle.loads(pa.assemble()), obj)
+        with PickleAssembler.from_bytes(pickle.dumps(obj, protocol=4)).view() as view:
+            pa = PickleAssembler.from_bytes(view)
+            pa.optimize()
+            self.assertNotIn(FRAME, [instruction.opcode for instruction in disassemble(pa.assemble())])
+            self.assertEqual(pickle.loads(pa.assemble()), obj)
+
+        pa = PickleAssembler(proto=4)
+        pa.push_none()
+        pa.memo_put(0)
+        pa.push_none()
+        pa.memo_memoize()
+        pa.push_none()
+        pa.memo_put(2)
+        pa.memo_get(1)
+        pa.append_raw(b'')
+        self.assertEqual(pa.optimize(), 3)  # entries stored before MEMOIZE are kept
+        self.assertEqual(pa.assemble(), b'\x80\x04Np0\nN\x94Ng1\n.')
+        pa = PickleAssembler(proto=2, ir=True)
+        pa.push_none()
+        pa.memo_put(0)
+        pa.append_raw(b'0')  # POP
+        self.assertEqual(pa.optimize(), 0)  # raw data may fetch any entry
+
+        with self.assertRaisesRegex(ValueError, re.escape('payload is not kept in memory when writing to a sink')):
+            PickleAssembler(proto=0, sink=io.BytesIO()).optimize()
+
+    def test_optimize_memo(self) -> None:
+        shared = ['x']
+        obj = [
+            shared, shared, ('y' * 300, shared), {'key': shared}, list(range(300)), 'z' * 100000,
+        ]  # type: list[object]
+        obj.append(obj)
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(proto=proto):
+                payload = pickle.dumps(obj, protocol=proto)
+                optimized = optimize_memo(payload)
+                if proto < 4:  # pickletools.optimize frames the pickle anew
+                    self.assertEqual(optimized, pickletools.optimize(payload))
+                result = pickle._loads(optimized)  # type: ignore[attr-defined]  # checks frames
+                self.assertEqual(repr(result), repr(obj))
+                self.assertIs(result[0], result[1])
+                self.assertIs(result[-1], result)
+                self.assertLess(len(optimized), len(payload))
+                self.assertEqual(optimize_memo(optimized), optimized)
+
+        pa = PickleAssembler(proto=4)
+        pa.push_none()
+        pa.memo_put(5)  # removed, but counted by MEMOIZE
+        pa.pop()
+        pa.push_true()
+        pa.memo_memoize()  # index 1
+        pa.push_none()
+        pa.memo_binput(1)  # overwrites index 1
+        pa.memo_binget(1)
+        pa.pop()
+        pa.memo_get(1)
+        self.assertEqual(optimize_memo(pa.assemble()), b'\x80\x04N0\x88\x94N\x94h\x010h\x01.')
+        pa = PickleAssembler(proto=4, frame_size=1)
+        pa.push_none()
+        pa.memo_put(0)  # its frame is left empty
+        pa.memo_put(1)
+        pa.memo_get(1)
+        pa.pop()
+        self.assertEqual(optimize_memo(pa.assemble()),
+                         b'\x80\x04\x95\x01\x00\x00\x00\x00\x00\x00\x00N\x95\x01\x00\x00\x00\x00\x00\x00\x00\x94'
+                         b'\x95\x02\x00\x00\x00\x00\x00\x00\x00h\x00\x95\x02\x00\x00\x00\x00\x00\x00\x000.')
+        self.assertEqual(optimize_memo(bytearray(b'N.')), b'N.')
+
+        for payload, message in ((b'h\x03.', 'memo entry 3 is fetched before being stored, at position 0'),
+                                 (b'N', 'pickle exhausted before seeing STOP'),
+                                 (b'N\xff.', "unknown opcode b'\\xff' at position 1"),
+                                 (b'B\x01', 'truncated argument of opcode BINBYTES at position 0'),
+                                 (b'Nh', 'truncated argument of opcode BINGET at position 1'),
+                                 (b'T\xff\xff\xff\xff.', 'invalid argument size of opcode BINSTRING at position 0'),
+                                 (b'g1', 'unterminated argument of opcode GET at position 0')):
+            with self.subTest(payload=payload), self.assertRaisesRegex(ValueError, re.escape(message)):
+                optimize_memo(payload)
+
+    def test_simulate(self) -> None:
+        obj = [('x', 1), {'key': [b'y' * 300]}, {2, 3}, frozenset([4])]  # type: list[object]
+        obj.append(obj)
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(proto=proto):
+                payload = pickle.dumps(obj, protocol=proto)
+                self.assertEqual(simulate(payload), (7, 8, 8, 7, 6, 6)[proto])  # as measured with pickle._Unpickler
+                self.assertEqual(simulate(memoryview(payload)), simulate(payload))
+        self.assertEqual(simulate(b'N(0\x85.'), 1)  # POP pops a mark if there is no item above it
+        self.assertEqual(simulate(b'N.N'), 1)  # the rest of the pickle is ignored
+
+        for payload, message in (
+                (b'N\x85\x86.', 'stack underflow at opcode TUPLE2 at position 2'),
+                (b'N(\x85.', 'stack underflow at opcode TUPLE1 at position 2'),
+                (b'0.', 'stack underflow at opcode POP at position 0'),
+                (b'N(.', 'stack underflow at opcode STOP at position 2'),
+                (b'q\x00N.', 'stack underflow at opcode BINPUT at position 0'),
+                (b'(o.', 'stack underflow at opcode OBJ at position 1'),
+                (b'(Ne.', 'stack underflow at opcode APPENDS at position 2'),
+                (b'Nt.', 'MARK not found for opcode TUPLE at position 1'),
+                (b'}(Nu.', 'odd number of items for opcode SETITEMS at position 3'),
+                (b'N\x94h\x01.', 'memo entry 1 is not set, at opcode BINGET at position 2'),
+                (b'g0\n.', 'memo entry 0 is not set, at opcode GET at position 0'),
+        ):
+            with self.subTest(payload=payload), self.assertRaisesRegex(PickleValidationError, re.escape(message)):
+                simulate(payload)
+        for payload, message in ((b'N', 'pickle exhausted before seeing STOP'),
+                                 (b'\xff.', "unknown opcode b'\\xff' at position 0"),
+                                 (b'B\x01', 'truncated argument of opcode BINBYTES at position 0'),
+                                 (b'Nh', 'truncated argument of opcode BINGET at position 1'),
+                                 (b'T\xff\xff\xff\xff.', 'invalid argument size of opcode BINSTRING at position 0'),
+                                 (b'ca\nb', 'unterminated argument of opcode GLOBAL at position 0')):
+            with self.subTest(payload=payload), self.assertRaisesRegex(ValueError, re.escape(message)):
+                simulate(payload)
+
+        for kwargs in ({}, {'ir': True}, {'buffer_size': 16}):
+            with self.subTest(**kwargs):
+                pa = PickleAssembler(proto=4, validate='assemble', **kwargs)
+                self.assertIsNone(pa.max_stack_depth)
+                pa.util_push([b'x' * 20, (1, 2)])
+                self.assertEqual(pickle.loads(pa.assemble()), [b'x' * 20, (1, 2)])
+                self.assertEqual(pa.max_stack_depth, 3)
+                pa.build_tuple()
+                with open(os.devnull, 'wb') as devnull:
+                    for output in (pa.assemble, pa.view, lambda: pa.assemble_into(bytearray(100)),
+                                   lambda: pa.write_to_fd(devnull.fileno())):
+                        with self.assertRaisesRegex(PickleValidationError, re.escape('MARK not found for opcode')):
+                            output()
+        pa = PickleAssembler.from_bytes(b'N.')
+        pa.pop()
+        self.assertEqual(pa.assemble(), b'N0.')  # not validated by default
+
+    def test_validate_incremental(self) -> None:
+        obj = [('x', 1), {'key': ['y' * 300, 'x']}, -2 ** 100, 'z' * 20, (), 2.5, None, True]  # type: list[object]
+        obj.append(obj)
+        for kwargs in ({}, {'batch_size': 2, 'ir': True}, {'buffer_size': 16}, {'sink': True}, {'verify': False}):
+            for proto in range(1, DEFAULT_TEST_PROTO + 1):
+                with self.subTest(proto=proto, **kwargs):
+                    sink = io.BytesIO()
+                    pa = PickleAssembler(proto=proto, validate='incremental', memoize='equality',
+                                         **dict(kwargs, sink=sink if kwargs.get('sink') else None))  # type: ignore
+                    pa.util_push(obj)
+                    payload = pa.assemble() or sink.getvalue()
+                    self.assertEqual(repr(pickle.loads(payload)), repr(obj))
+                    self.assertEqual(pa.max_stack_depth, simulate(payload))
+
+        pa = PickleAssembler(proto=4, validate='incremental')
+        pa.push_mark()
+        for method, args, message in (
+                (pa.build_tuple2, (), 'stack underflow at opcode TUPLE2'),
+                (pa.build_setitems, (), 'stack underflow at opcode SETITEMS'),
+                (pa.memo_binget, (0,), 'memo entry 0 is not set, at opcode BINGET'),
+                (pa.memo_put, (0,), 'stack underflow at opcode PUT'),
+                (pa.memo_memoize, (), 'stack underflow at opcode MEMOIZE'),
+                (pa.memo_allocator.put, (), 'stack underflow at opcode MEMOIZE'),
+                (pa.append_raw, (b'(Nu',), 'odd number of items for opcode SETITEMS at position 2'),
+        ):
+            with self.subTest(method=method.__name__):
+                with self.assertRaisesRegex(PickleValidationError, re.escape(message)):
+                    method(*args)
+        pa.push_none()
+        self.assertEqual(pa.assemble(), b'\x80\x04(N.')  # nothing else has been written
+        pa.pop()
+        pa.pop()  # pops the mark
+        with self.assertRaisesRegex(PickleValidationError, re.escape('MARK not found for opcode LIST')):
+            pa.build_list()
+        with self.assertRaisesRegex(TypeError, re.escape('memo index should be an integer')):
+            pa.memo_get('x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(ValueError, re.escape('truncated argument of opcode BININT1 at position 1')):
+            pa.append_raw(b'NK')
+        pa.append_raw(b'N')
+        pa.memo_put(index=1)
+        pa.memo_memoize()  # index 1 is the second entry, as the memo had a single one
+        pa.pop()
+        pa.memo_get(1)
+        pa.push_binunicode('x')
+        pa.build_tuple2()
+        self.assertEqual(pa.assemble(), b'\x80\x04(N00Np1\n\x940g1\nX\x01\x00\x00\x00x\x86.')
+        self.assertEqual(pa.max_stack_depth, 2)
+        pa.pop()
+        with self.assertRaisesRegex(PickleValidationError, re.escape('stack underflow at opcode STOP')):
+            pa.assemble()
+        with self.assertRaisesRegex(PickleValidationError, re.escape('stack underflow at opcode STOP')):
+            PickleAssembler(proto=0, sink=io.BytesIO(), validate='incremental').assemble()
+        with self.assertRaises(PickleProtocolMismatchError):
+            PickleAssembler(proto=0, validate='incremental').push_empty_set()
+
+        class CustomAssembler(PickleAssembler):
+            def push_none(self) -> None:
+                self.push_true()
+
+            def build_tuple(self) -> None:
+                super().build_tuple()
+
+        for options in ({}, {'verify': False}, {'validate': 'incremental'}):
+            with self.subTest(**options):
+                pa = CustomAssembler(proto=4, **options)
+                pa.push_mark()
+                pa.push_none()
+                pa.build_tuple()
+                self.assertEqual(pickle.loads(pa.assemble()), (True,))
+        self.assertEqual(pa.max_stack_depth, 1)  # each overridden method is validated as a single opcode
+        pa.pop()
+        with self.assertRaisesRegex(PickleValidationError, re.escape('stack underflow at opcode POP')):
+            pa.pop()
 
     def test_append_raw(self) -> None:
         pa = PickleAssembler(proto=0)
@@ -130,6 +864,15 @@ class TestPickleAssembler(unittest.TestCase):
                 getattr(pa, function)(arg)
                 self.assertEqual(pickle.loads(pa.assemble()), arg)
 
+    def test_push_unicode_escape(self) -> None:
+        value = 'a\\b\0c\nd\re\x1af\u4e2d\U0001f600\\u0041'
+        pa = PickleAssembler(proto=0)
+        pa.push_unicode(value)
+        payload = pa.assemble()
+        self.assertEqual(payload, UNICODE + b'a\\u005cb\\u0000c\\u000ad\\u000de\\u001af'
+                                            b'\\u4e2d\\U0001f600\\u005cu0041\n' + STOP)
+        self.assertEqual(pickle.loads(payload), value)
+
     def test_push_global(self) -> None:
         pa = PickleAssembler(proto=DEFAULT_TEST_PROTO)
         pa.push_global('__main__', 'SampleClass')
@@ -377,7 +1120,12 @@ class TestPickleAssembler(unittest.TestCase):
             (256, 1, BININT2 + p16(256) + b'.'),
             (65535, 1, BININT2 + p16(65535) + b'.'),
             (65536, 1, BININT + p32(65536, signed=True) + b'.'),
-            (-1, 1, BININT + p32(-1, signed=True) + b'.'),
+            (-1, 1, INT + b'-1\n.'),
+            (-9, 1, INT + b'-9\n.'),
+            (-10, 1, BININT + p32(-10, signed=True) + b'.'),
+            (-1, 2, PROTO + p8(2) + LONG1 + p8(1) + b'\xff.'),
+            (- 2 ** 15, 2, PROTO + p8(2) + LONG1 + p8(2) + p16(- 2 ** 15, signed=True) + b'.'),
+            (- 2 ** 15 - 1, 2, PROTO + p8(2) + BININT + p32(- 2 ** 15 - 1, signed=True) + b'.'),
             (2 ** 31 - 1, 1, BININT + p32(2 ** 31 - 1, signed=True) + b'.'),
             (2 ** 31, 1, INT + b'2147483648\n.'),
             (2 ** 31, 2, PROTO + p8(2) + LONG1 + p8(5) + pack(2 ** 31, endian='<', signed=True) + b'.'),
@@ -392,6 +1140,7 @@ class TestPickleAssembler(unittest.TestCase):
             ('bar\n\u4e2d\u6587', 3, PROTO + p8(3) + BINUNICODE + p32(10) + b'bar\n\xe4\xb8\xad\xe6\x96\x87.'),
             ('bar\n\u4e2d\u6587', 4, PROTO + p8(4) + SHORT_BINUNICODE + p8(10) + b'bar\n\xe4\xb8\xad\xe6\x96\x87.'),
             ('x' * 256, 4, PROTO + p8(4) + BINUNICODE + p32(256) + b'x' * 256 + b'.'),
+            ('\ud800', 4, PROTO + p8(4) + SHORT_BINUNICODE + p8(3) + b'\xed\xa0\x80.'),
             ((), 0, MARK + TUPLE + b'.'),
             ((), 1, EMPTY_TUPLE + b'.'),
             ((1,), 1, MARK + BININT1 + p8(1) + TUPLE + b'.'),
@@ -416,6 +1165,29 @@ class TestPickleAssembler(unittest.TestCase):
                 self.assertEqual(result, expected_result)
                 self.assertEqual(pickle.loads(result), arg)
 
+    def test_util_push_int_size(self) -> None:
+        methods = ['push_int', 'push_long', 'push_binint', 'push_binint1', 'push_binint2', 'push_long1', 'push_long4']
+        values = {0, 2 ** 2039 - 1, 2 ** 2039, - 2 ** 2039, - 2 ** 2039 - 1}
+        for bits in range(66):
+            values.update({2 ** bits - 1, 2 ** bits, 2 ** bits + 1, - 2 ** bits + 1, - 2 ** bits, - 2 ** bits - 1})
+        values.update(- 10 ** digits for digits in range(6))
+        for proto in range(HIGHEST_PROTOCOL + 1):
+            for value in sorted(values):
+                with self.subTest(proto=proto, value=value):
+                    pa = PickleAssembler(proto=proto)
+                    pa.util_push(value)
+                    sizes = []
+                    for method in methods:
+                        candidate = PickleAssembler(proto=proto)
+                        try:
+                            getattr(candidate, method)(value)
+                        except (ValueError, PickleProtocolMismatchError):
+                            continue
+                        sizes.append(len(candidate.assemble()))
+                    self.assertEqual(len(pa.assemble()), min(sizes))
+                    if proto <= DEFAULT_TEST_PROTO:  # protocols above are not supported by the running pickle
+                        self.assertEqual(pickle.loads(pa.assemble()), value)
+
     def test_util_push_nested(self) -> None:
         obj = {(None, True): [{-1: 3.14}, 'boo']}
         for proto in range(DEFAULT_TEST_PROTO + 1):
@@ -431,6 +1203,180 @@ class TestPickleAssembler(unittest.TestCase):
                 pa.util_push(obj)
                 self.assertEqual(pickle.loads(pa.assemble()), obj)
 
+    def test_util_push_batched(self) -> None:
+        test_cases = [
+            ([], 1, EMPTY_LIST + b'.'),
+            ([1], 1, EMPTY_LIST + BININT1 + p8(1) + APPEND + b'.'),
+            ([1, 2, 3], 1, EMPTY_LIST + MARK + BININT1 + p8(1) + BININT1 + p8(2) + APPENDS + BININT1 + p8(3) + APPEND + b'.'),  # noqa: E501  # pylint: disable=line-too-long
+            ([1, 2], 0, MARK + LIST + INT + b'1\n' + APPEND + INT + b'2\n' + APPEND + b'.'),
+            ({}, 1, EMPTY_DICT + b'.'),
+            ({1: 2, 3: 4}, 1, EMPTY_DICT + MARK + BININT1 + p8(1) + BININT1 + p8(2) + BININT1 + p8(3) + BININT1 + p8(4) + SETITEMS + b'.'),  # noqa: E501  # pylint: disable=line-too-long
+            ({1: 2}, 0, MARK + DICT + INT + b'1\n' + INT + b'2\n' + SETITEM + b'.'),
+        ]  # type: list[tuple[object, int, bytes]]
+
+        for test_case in test_cases:
+            arg, proto, expected_result = test_case
+            with self.subTest(test_case=test_case):
+                pa = PickleAssembler(proto=proto, batch_size=2)
+                pa.util_push(arg)
+                result = pa.assemble()
+                self.assertEqual(result, expected_result)
+                self.assertEqual(pickle.loads(result), arg)
+
+        obj = {i: [list(range(i)), {'x': i}] for i in range(10)}
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(obj=obj, proto=proto):
+                pa = PickleAssembler(proto=proto, batch_size=3)
+                pa.util_push(obj)
+                self.assertEqual(pickle.loads(pa.assemble()), obj)
+
+    def test_util_push_memoize(self) -> None:
+        key = 'key'
+        inner = [1]
+        obj = [key, (key, b'x'), (), (), inner, {key: inner}, ''.join(['k', 'ey'])]
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            for memoize in ('identity', 'equality'):
+                with self.subTest(proto=proto, memoize=memoize):
+                    pa = PickleAssembler(proto=proto, memoize=memoize)
+                    pa.push_mark()
+                    pa.util_push(obj if proto >= 3 else obj[:1] + obj[2:])
+                    pa.util_push(inner)
+                    pa.build_tuple()
+                    result, result_inner = pickle.loads(pa.assemble())
+                    self.assertEqual(result, obj if proto >= 3 else obj[:1] + obj[2:])
+                    self.assertIs(result[-3], result[-2][key])
+                    self.assertIs(result[-3], result_inner)
+                    self.assertIs(result[-1] is result[0], memoize == 'equality')
+
+        pa = PickleAssembler(proto=4, memoize='identity')
+        pa.util_push([key, key])
+        self.assertEqual(pa.assemble(), PROTO + p8(4) + EMPTY_LIST + MEMOIZE + MARK + SHORT_BINUNICODE + p8(3) + b'key'
+                         + MEMOIZE + BINGET + p8(1) + APPENDS + b'.')
+
+        pa = PickleAssembler(proto=1, memoize='identity')
+        pa.util_push([key, key])
+        self.assertEqual(pa.assemble(), EMPTY_LIST + BINPUT + p8(0) + MARK + BINUNICODE + p32(3) + b'key'
+                         + BINPUT + p8(1) + BINGET + p8(1) + APPENDS + b'.')
+
+    def test_util_push_recursive(self) -> None:
+        recursive_list = [1]  # type: list[object]
+        recursive_list.append(recursive_list)
+        recursive_dict = {}  # type: dict[object, object]
+        recursive_dict['self'] = recursive_dict
+        recursive_tuple = ([],)  # type: tuple[list[object]]
+        recursive_tuple[0].append(recursive_tuple)
+        recursive_long_tuple = (1, 2, 3, [])  # type: tuple[int, int, int, list[object]]
+        recursive_long_tuple[3].append(recursive_long_tuple)
+        obj = [recursive_list, recursive_dict, recursive_tuple, recursive_long_tuple, recursive_list]
+
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(proto=proto):
+                pa = PickleAssembler(proto=proto, memoize='identity')
+                pa.util_push(obj)
+                result = pickle.loads(pa.assemble())
+                self.assertIs(result[0][1], result[0])
+                self.assertIs(result[4], result[0])
+                self.assertIs(result[1]['self'], result[1])
+                self.assertIs(result[2][0][0], result[2])
+                self.assertIs(result[3][3][0], result[3])
+                self.assertEqual(result[3][:3], (1, 2, 3))
+
+        pa = PickleAssembler(proto=DEFAULT_TEST_PROTO)
+        with self.assertRaisesRegex(ValueError, re.escape('recursive objects are only supported by `util_push` through lists and dicts with memoize')):  # noqa: E501  # pylint: disable=line-too-long
+            pa.util_push(obj)
+
+        class CustomAssembler(PickleAssembler):
+            pass
+
+        def push_sample(pa: PickleAssembler, value: SampleClass) -> 'tuple[list[object], Callable[[], None]]':
+            pa.push_mark()
+            pa.push_global('__main__', 'SampleClass')
+            return [value.attr1], pa.build_obj
+
+        CustomAssembler.register_util_push_type(SampleClass, push_sample)
+        sample = SampleClass()
+        sample.attr1 = (sample,)
+        pa = CustomAssembler(proto=DEFAULT_TEST_PROTO, memoize='identity')
+        with self.assertRaisesRegex(ValueError, re.escape('recursive objects are only supported by `util_push` through lists and dicts with memoize')):  # noqa: E501  # pylint: disable=line-too-long
+            pa.util_push(sample)
+
+    def test_util_push_deeply_nested(self) -> None:
+        depth = sys.getrecursionlimit() * 10
+        obj = []  # type: list[object]
+        for _ in range(depth):
+            obj = [obj, (1,)]
+        pa = PickleAssembler(proto=DEFAULT_TEST_PROTO)
+        pa.util_push(obj)
+        result = pickle.loads(pa.assemble())
+        for _ in range(depth):
+            self.assertEqual(len(result), 2)
+            self.assertEqual(result[1], (1,))
+            result = result[0]
+        self.assertEqual(result, [])
+
+    def test_util_push_subclass(self) -> None:
+        class IntSubclass(int):
+            pass
+
+        class ListSubclass(list):  # type: ignore[type-arg]
+            pass
+
+        pa = PickleAssembler(proto=DEFAULT_TEST_PROTO)
+        pa.util_push(ListSubclass([IntSubclass(1), True]))
+        result = pickle.loads(pa.assemble())
+        self.assertIs(type(result), list)
+        self.assertEqual(result, [1, True])
+        self.assertIs(type(result[0]), int)
+
+    def test_register_util_push_type(self) -> None:
+        class CustomAssembler(PickleAssembler):
+            pass
+
+        def push_sample(pa: PickleAssembler, value: SampleClass) -> 'tuple[list[object], Callable[[], None]]':
+            pa.push_mark()
+            pa.push_global('__main__', 'SampleClass')
+            return [value.attr1], pa.build_obj
+
+        CustomAssembler.register_util_push_type(SampleClass, push_sample)
+        CustomAssembler.register_util_push_type(set, lambda pa, value: pa.util_push(sorted(value)))
+
+        pa = CustomAssembler(proto=DEFAULT_TEST_PROTO)  # type: PickleAssembler
+        pa.util_push([SampleClass([SampleClass(1)]), {2, 1}])
+        self.assertEqual(pickle.loads(pa.assemble()), [SampleClass([SampleClass(1)]), [1, 2]])
+
+        pa = PickleAssembler(proto=DEFAULT_TEST_PROTO)
+        with self.assertRaisesRegex(TypeError, re.escape('is currently unsupported by `util_push`')):
+            pa.util_push(SampleClass())
+
+        with self.assertRaisesRegex(TypeError, re.escape('value type should be a type')):
+            CustomAssembler.register_util_push_type(1, push_sample)  # type: ignore[arg-type]
+        with self.assertRaisesRegex(TypeError, re.escape('handler should be callable')):
+            CustomAssembler.register_util_push_type(SampleClass, 1)  # type: ignore[arg-type]
+
+    def test_util_push_buffer(self) -> None:
+        pa = PickleAssembler(proto=4)
+        with self.assertRaisesRegex(PickleProtocolMismatchError,
+                                    re.escape('must use at least protocol 5 to push out-of-band buffers')):
+            pa.util_push(memoryview(b'x'))
+
+        if DEFAULT_TEST_PROTO < 5:  # pragma: no cover
+            return
+        data = bytearray(b'abc')
+        readonly_data = b'def'
+        pa = PickleAssembler(proto=5)
+        pa.util_push([memoryview(data), pickle.PickleBuffer(readonly_data)])
+        payload = pa.assemble()
+        self.assertEqual(payload, PROTO + p8(5) + MARK + NEXT_BUFFER + NEXT_BUFFER + READONLY_BUFFER + LIST + b'.')
+        self.assertEqual(len(pa.buffers), 2)
+        result = pickle.loads(payload, buffers=pa.buffers)
+        self.assertEqual([bytes(buf) for buf in result], [b'abc', b'def'])
+        data[0] = ord('x')  # buffers are not copied
+        self.assertEqual(bytes(result[0]), b'xbc')
+        self.assertTrue(memoryview(result[1]).readonly)
+
+        with self.assertRaisesRegex(TypeError, re.escape('value should be a memoryview or PickleBuffer')):
+            pa._util_push_buffer(b'x')  # pylint: disable=protected-access
+
     def test_util_push_bytes_min_proto(self) -> None:
         pa = PickleAssembler(proto=2)
         with self.assertRaisesRegex(PickleProtocolMismatchError,
@@ -450,6 +1396,78 @@ class TestPickleAssembler(unittest.TestCase):
                     pa.util_memo_get(index)
                     self.assertEqual(pickle.loads(pa.assemble()), obj)
 
+    def test_memo_allocator(self) -> None:
+        pa = PickleAssembler(proto=4)
+        pa.push_empty_list()
+        handle = pa.memo_allocator.put()
+        pa.memo_allocator.get(handle)
+        pa.build_append()
+        self.assertEqual(handle, 0)
+        self.assertEqual(pa.assemble(), PROTO + p8(4) + EMPTY_LIST + MEMOIZE + BINGET + p8(0) + APPEND + b'.')
+
+        for proto in range(DEFAULT_TEST_PROTO + 1):
+            with self.subTest(proto=proto):
+                pa = PickleAssembler(proto=proto)
+                pa.push_mark()
+                handles = []
+                for i in range(300):
+                    pa.util_push(i)
+                    handles.append(pa.memo_allocator.put())
+                for _ in range(10):
+                    pa.memo_allocator.get(handles[-1])
+                view = pa.view()
+                payload = pa.assemble()
+                self.assertEqual(view, payload)
+                view.release()
+                pa.build_tuple()
+                self.assertEqual(pickle.loads(pa.assemble()), tuple(range(300)) + (299,) * 10)
+                if 1 <= proto <= 3:  # the most fetched entry gets a one-byte index
+                    self.assertEqual(payload.count(BINGET + p8(0)), 10)
+
+                pa.memo_allocator.get(handles[0])  # indices are not reassigned once picked
+                self.assertEqual(pickle.loads(pa.assemble()), 0)
+
+        payloads = []  # type: list[bytes]
+        for ir in (False, True):
+            pa = PickleAssembler(proto=2, ir=ir)
+            pa.push_mark()
+            handles = []
+            for i in range(300):
+                pa.util_push(i)
+                handles.append(pa.memo_allocator.put())
+            for _ in range(50):
+                pa.memo_allocator.get(handles[-1])
+            pa.build_tuple()
+            copied = copy.copy(pa)
+            unpickled = pickle.loads(pickle.dumps(pa))
+            payloads += (pa.assemble(), copied.assemble(), unpickled.assemble())
+        self.assertEqual(payloads, [payloads[0]] * 6)  # memo opcodes recorded in `ir` are renumbered as well
+        self.assertEqual(payloads[0].count(BINGET + p8(0)), 50)
+
+        pa = PickleAssembler(proto=4, ir=True)
+        pa.push_none()
+        handle = pa.memo_allocator.put()
+        pa.memo_allocator.get(handle)
+        self.assertEqual([(instruction.opcode, instruction.arg) for instruction in cast(PickleIR, pa.ir)],
+                         [(NONE, None), (MEMOIZE, None), (BINGET, 0)])
+        pa.memo_allocator.get(handle)
+        pa.build_tuple3()
+        self.assertEqual(pa.assemble(), PROTO + p8(4) + NONE + MEMOIZE + (BINGET + p8(0)) * 2 + TUPLE3 + b'.')
+
+        sink = io.BytesIO()
+        pa = PickleAssembler(proto=4, sink=sink)
+        pa.push_none()
+        handle = pa.memo_allocator.put()
+        pa.memo_allocator.get(handle)
+        pa.build_tuple2()
+        pa.assemble()
+        self.assertEqual(sink.getvalue(), PROTO + p8(4) + NONE + MEMOIZE + BINGET + p8(0) + TUPLE2 + b'.')
+
+        with self.assertRaisesRegex(TypeError, re.escape('memo handle should be an integer')):
+            pa.memo_allocator.get('x')  # type: ignore[arg-type]
+        with self.assertRaisesRegex(ValueError, re.escape('unknown memo handle')):
+            pa.memo_allocator.get(1)
+
     def test_string_encoding(self) -> None:
         test_cases = [
             ('push_string', '\xcc', 'latin-1'),
@@ -495,12 +1513,12 @@ class TestPickleAssembler(unittest.TestCase):
             ('push_short_binstring', (b'x',), TypeError, 'value should be str'),
             ('push_short_binstring', ('x', 'x'), LookupError, 'unknown encoding'),
             ('push_short_binstring', ('A' * 256,), ValueError, 'string too long for opcode SHORT_BINSTRING'),
-            ('push_binbytes', (1,), TypeError, 'value should be bytes'),
-            ('push_binbytes', ('x',), TypeError, 'value should be bytes'),
-            ('push_binbytes8', (1,), TypeError, 'value should be bytes'),
-            ('push_binbytes8', ('x',), TypeError, 'value should be bytes'),
-            ('push_short_binbytes', (1,), TypeError, 'value should be bytes'),
-            ('push_short_binbytes', ('x',), TypeError, 'value should be bytes'),
+            ('push_binbytes', (1,), TypeError, 'value should be a bytes-like object'),
+            ('push_binbytes', ('x',), TypeError, 'value should be a bytes-like object'),
+            ('push_binbytes8', (1,), TypeError, 'value should be a bytes-like object'),
+            ('push_binbytes8', ('x',), TypeError, 'value should be a bytes-like object'),
+            ('push_short_binbytes', (1,), TypeError, 'value should be a bytes-like object'),
+            ('push_short_binbytes', ('x',), TypeError, 'value should be a bytes-like object'),
             ('push_short_binbytes', (b'\xcc' * 256,), ValueError, 'bytes too long for opcode SHORT_BINBYTES'),
             ('push_unicode', (1,), TypeError, 'value should be str'),
             ('push_unicode', (b'x',), TypeError, 'value should be str'),
@@ -531,10 +1549,11 @@ class TestPickleAssembler(unittest.TestCase):
             ('memo_long_binput', ('x',), TypeError, 'memo index should be an integer'),
             ('memo_long_binput', (-1,), ValueError, 'memo index out of range for opcode LONG_BINPUT'),
             ('memo_long_binput', (2 ** 32,), ValueError, 'memo index out of range for opcode LONG_BINPUT'),
+            ('_util_push_none', (0,), TypeError, 'value should be None'),
             ('_util_push_bool', (1,), TypeError, 'value should be a bool'),
             ('_util_push_int', (1.1,), TypeError, 'value should be an integer'),
             ('_util_push_float', ('x',), TypeError, 'value should be a float'),
-            ('_util_push_bytes', ('x',), TypeError, 'value should be bytes'),
+            ('_util_push_bytes', ('x',), TypeError, 'value should be a bytes-like object'),
             ('_util_push_unicode', (b'x',), TypeError, 'value should be str'),
             ('_util_push_tuple', ([],), TypeError, 'value should be tuple'),
             ('_util_push_list', ((),), TypeError, 'value should be list'),
@@ -548,8 +1567,8 @@ class TestPickleAssembler(unittest.TestCase):
 
         if DEFAULT_TEST_PROTO >= 5:  # pragma: no cover
             test_cases += [
-                ('push_bytearray8', (1,), TypeError, 'value should be bytes or bytearray'),
-                ('push_bytearray8', ('x',), TypeError, 'value should be bytes or bytearray'),
+                ('push_bytearray8', (1,), TypeError, 'value should be a bytes-like object'),
+                ('push_bytearray8', ('x',), TypeError, 'value should be a bytes-like object'),
             ]
 
         for test_case in test_cases:
@@ -599,6 +1618,8 @@ class TestPickleAssembler(unittest.TestCase):
             ('build_stack_global', (), 4),
             ('memo_memoize', (), 4),
             ('push_bytearray8', (b'x',), 5),
+            ('push_next_buffer', (), 5),
+            ('build_readonly_buffer', (), 5),
         ]  # type: list[tuple[str, tuple[object, ...], int]]
 
         for test_case in test_cases:
@@ -711,10 +1732,60 @@ class TestPickleAssembler(unittest.TestCase):
         self.assertEqual(opcode.name, 'LONG_BINGET')
         opcode = _method_name_to_opcode('push_empty_dict')
         self.assertEqual(opcode.name, 'EMPTY_DICT')
+        opcode = _method_name_to_opcode('build_readonly_buffer')
+        self.assertEqual(opcode.name, 'READONLY_BUFFER')
 
     def test_method_decorator(self) -> None:
         self.assertEqual(PickleAssembler.build_append.__doc__, 'Corresponds to the ``APPEND`` opcode.')
 
+        # Protocol verification is resolved by a class specialized for the protocol, available opcode methods are not
+        # wrapped, and nothing is added to the instance.
+        pa = PickleAssembler(proto=2)
+        self.assertEqual(pa.push_empty_set.__doc__, 'Corresponds to the ``EMPTY_SET`` opcode.')
+        self.assertIsInstance(pa, PickleAssembler)
+        self.assertIs(type(pa), type(PickleAssembler(proto=2)))
+        self.assertIn('push_empty_set', vars(type(pa)))
+        self.assertNotIn('build_tuple1', vars(type(pa)))
+        self.assertNotIn('push_empty_set', vars(pa))
+        self.assertIs(type(PickleAssembler(proto=2, verify=False)), PickleAssembler)
+        self.assertIs(type(type(pa)(proto=2, verify=False)), PickleAssembler)
+
+        # Opcode methods validating opcodes incrementally are wrapped by a class specialized for it as well.
+        pa = PickleAssembler(proto=2, validate='incremental')
+        self.assertEqual(pa.push_empty_set.__doc__, 'Corresponds to the ``EMPTY_SET`` opcode.')
+        self.assertIs(type(pa), type(PickleAssembler(proto=2, validate='incremental')))
+        self.assertIsNot(type(pa), type(PickleAssembler(proto=2)))
+        self.assertIsNot(type(PickleAssembler(proto=2, verify=False, validate='incremental')), PickleAssembler)
+        self.assertEqual(vars(pa).keys() & vars(PickleAssembler).keys(), set())
+
+        class CustomAssembler(PickleAssembler):
+            pass
+
+        pa = CustomAssembler(proto=2)
+        self.assertIsInstance(pa, CustomAssembler)
+        self.assertIsNot(type(pa), type(PickleAssembler(proto=2)))
+        with self.assertRaises(PickleProtocolMismatchError):
+            pa.push_empty_set()
+
+    def test_pickle_assembler(self) -> None:
+        for proto in range(HIGHEST_PROTOCOL + 1):
+            for kwargs in ({}, {'verify': False}, {'memoize': 'identity'}, {'ir': True}, {'validate': 'incremental'}):
+                with self.subTest(proto=proto, kwargs=kwargs):
+                    pa = PickleAssembler(proto=proto, **kwargs)
+                    shared = ['x']
+                    pa.push_mark()
+                    pa.util_push([shared, shared])
+                    copied = pickle.loads(pickle.dumps(pa))  # nosec
+                    self.assertIs(type(copied), type(pa))
+                    for assembler in (pa, copied):
+                        assembler.util_push(1)
+                        assembler.build_tuple()
+                    self.assertEqual(copied.assemble(), pa.assemble())
+                    self.assertEqual(pickle.loads(pa.assemble()), ([['x'], ['x']], 1))  # nosec
+                    if proto < HIGHEST_PROTOCOL and 'verify' not in kwargs:
+                        with self.assertRaises(PickleProtocolMismatchError):
+                            copied.push_next_buffer()
+
     def test_exploit(self) -> None:
         pa = PickleAssembler(proto=0)
         pa.push_mark()